@@ -0,0 +1,281 @@
+"""
+Микробенчмарк горячих путей БД на синтетических базах разного размера.
+
+Меряем ровно те функции, которые зовут хендлеры бота:
+    track_user_event, user_has_subscription (через кеш и напрямую в БД),
+    create_or_extend_subscription, save_payment,
+    запросы /stats (users.stats + subscriptions.count_active) и /subs (list_all + last_per_user).
+
+Замер в духе timeit: repeat раундов по number вызовов, в отчёт — лучший и медианный раунд
+(время на одну операцию). Базы генерируются один раз и кешируются в --workdir.
+
+    python bench/db_bench.py                                  # 1k, 100k, 1M
+    python bench/db_bench.py --sizes 1k,100k --json out.json
+    python bench/db_bench.py --save-baseline baseline.json    # запомнить как эталон
+    python bench/db_bench.py --baseline baseline.json         # сравнить; exit 1 при регрессии
+
+Эталон в репозиторий не кладём — он зависит от машины; сравнивать имеет смысл на одной и той же.
+Синтетика пишется напрямую в SQLite, поэтому бенчмарк — только для STORAGE_BACKEND=sqlite.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+import bot  # noqa: E402
+from storage import SQLiteStorage, epoch_day  # noqa: E402
+
+DEFAULT_SIZES = "1k,100k,1m"
+SEED = 42
+INSERT_BATCH = 50_000
+SUBSCRIBER_SHARE = 0.3
+TRAINED_SHARE = 0.6
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().lower()
+    for suffix, mult in (("k", 1_000), ("m", 1_000_000)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * mult)
+    return int(value)
+
+
+def size_label(size: int) -> str:
+    if size >= 1_000_000 and size % 1_000_000 == 0:
+        return f"{size // 1_000_000}m"
+    if size >= 1_000 and size % 1_000 == 0:
+        return f"{size // 1_000}k"
+    return str(size)
+
+
+# ====== СИНТЕТИЧЕСКАЯ БАЗА ======
+def _fill(path: Path, size: int):
+    """users на size пользователей, ~30% с подпиской (часть уже истекла), по платежу на подписчика."""
+    rng = random.Random(SEED)
+    now = datetime.now(timezone.utc)
+    today = epoch_day(now.date())
+
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+
+    for first in range(1, size + 1, INSERT_BATCH):
+        users, subs, payments = [], [], []
+        for user_id in range(first, min(first + INSERT_BATCH, size + 1)):
+            first_seen = now - timedelta(days=rng.randint(0, 365), seconds=rng.randint(0, 86399))
+            last_seen = first_seen + timedelta(days=rng.randint(0, 30))
+            trained = rng.randint(1, 40) if rng.random() < TRAINED_SHARE else 0
+            users.append(
+                (user_id, f"user{user_id}", first_seen.isoformat(), last_seen.isoformat(), rng.randint(1, 5), trained)
+            )
+
+            if rng.random() < SUBSCRIBER_SHARE:
+                plan_key, days = ("year", 365) if rng.random() < 0.2 else ("month", 30)
+                end_day = today + rng.randint(-days, days)
+                start_day = end_day - days
+                subs.append(
+                    (
+                        user_id,
+                        bot.from_epoch_day(start_day).isoformat(),
+                        bot.from_epoch_day(end_day).isoformat(),
+                        start_day,
+                        end_day,
+                    )
+                )
+                payments.append(
+                    (
+                        user_id,
+                        f"synthetic-{user_id}",
+                        bot.SUBSCRIPTION_PLANS[plan_key]["price"],
+                        "XTR",
+                        (now - timedelta(days=rng.randint(0, days))).isoformat(),
+                        plan_key,
+                        days,
+                    )
+                )
+
+        cur.executemany(
+            "INSERT INTO users (user_id, username, first_seen, last_seen, starts_count, trainings_opened) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            users,
+        )
+        cur.executemany(
+            "INSERT INTO subscriptions (user_id, start_date, end_date, start_day, end_day) VALUES (?, ?, ?, ?, ?)",
+            subs,
+        )
+        cur.executemany(
+            "INSERT INTO payments (user_id, charge_id, amount, currency, paid_at, plan_key, duration_days) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            payments,
+        )
+        conn.commit()
+
+    cur.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+
+async def prepare_db(workdir: Path, size: int, regenerate: bool) -> Path:
+    path = workdir / f"corpus-bench-{size_label(size)}.db"
+    if path.exists() and not regenerate:
+        return path
+
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{path}{suffix}").unlink(missing_ok=True)
+
+    started = time.perf_counter()
+    await SQLiteStorage(path).init_schema()
+    await asyncio.to_thread(_fill, path, size)
+    print(f"  generated {path.name} in {time.perf_counter() - started:.1f}s")
+    return path
+
+
+# ====== ЗАМЕРЫ ======
+async def measure(op, number: int, repeat: int) -> dict:
+    """repeat раундов по number вызовов op(i); время на одну операцию в микросекундах."""
+    rounds = []
+    i = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            await op(i)
+            i += 1
+        rounds.append((time.perf_counter() - started) / number * 1e6)
+    return {
+        "number": number,
+        "repeat": repeat,
+        "best_us": round(min(rounds), 2),
+        "median_us": round(statistics.median(rounds), 2),
+    }
+
+
+def build_cases(size: int, number: int):
+    """(имя, op(i), сколько вызовов в раунде). Агрегаты на больших базах дорогие — их зовём по разу."""
+    rng = random.Random(SEED)
+    user_ids = [rng.randint(1, size) for _ in range(number)]
+    pick = lambda i: user_ids[i % number]  # noqa: E731
+    today = bot.today_epoch_day()
+    week_ago = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
+
+    async def has_sub_cached(i):
+        await bot.user_has_subscription(pick(i))
+
+    async def has_sub_db(i):
+        bot.ACTIVE_SUBS.loaded = False
+        try:
+            await bot.user_has_subscription(pick(i))
+        finally:
+            bot.ACTIVE_SUBS.loaded = True
+
+    async def stats_queries(i):
+        await bot.STORAGE.users.stats(week_ago)
+        await bot.STORAGE.subscriptions.count_active(today)
+
+    async def subs_queries(i):
+        await bot.STORAGE.subscriptions.list_all()
+        await bot.STORAGE.payments.last_per_user()
+
+    return [
+        ("track_user_event", lambda i: bot.track_user_event(pick(i), f"user{pick(i)}"), number),
+        ("user_has_subscription[cache]", has_sub_cached, number),
+        ("user_has_subscription[db]", has_sub_db, number),
+        ("create_or_extend_subscription", lambda i: bot.create_or_extend_subscription(pick(i), days=30), number),
+        ("save_payment", lambda i: bot.save_payment(pick(i), f"bench-{i}", 1490, "XTR", "month", 30), number),
+        ("stats_queries", stats_queries, 1),
+        ("subs_queries", subs_queries, 1),
+    ]
+
+
+async def bench_size(path: Path, size: int, number: int, repeat: int) -> dict:
+    bot.STORAGE = SQLiteStorage(path)
+    bot.ACTIVE_SUBS.load(await bot.STORAGE.subscriptions.active(bot.today_epoch_day()))
+
+    results = {}
+    try:
+        for name, op, case_number in build_cases(size, number):
+            results[name] = await measure(op, case_number, repeat)
+            print(f"  {name:<32}{results[name]['best_us']:>14.1f} µs/op")
+    finally:
+        await bot.close_db()
+    return results
+
+
+# ====== ЭТАЛОН ======
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Сравнение по лучшему раунду: медленнее эталона больше чем на tolerance — регрессия."""
+    regressions = []
+    print(f"\n{'size':<6}{'case':<32}{'baseline µs':>14}{'current µs':>14}{'ratio':>8}")
+    for size, cases in current["results"].items():
+        for name, row in cases.items():
+            base = baseline.get("results", {}).get(size, {}).get(name)
+            if not base:
+                continue
+            ratio = row["best_us"] / base["best_us"] if base["best_us"] else 1.0
+            mark = ""
+            if ratio > 1 + tolerance:
+                mark = "  REGRESSION"
+                regressions.append(f"{size}/{name}: x{ratio:.2f}")
+            print(f"{size:<6}{name:<32}{base['best_us']:>14.1f}{row['best_us']:>14.1f}{ratio:>8.2f}{mark}")
+    return regressions
+
+
+async def main_async(args) -> dict:
+    workdir = Path(args.workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.platform(),
+        "results": {},
+    }
+    for size in [parse_size(s) for s in args.sizes.split(",")]:
+        label = size_label(size)
+        print(f"[{label}]")
+        path = await prepare_db(workdir, size, args.regenerate)
+        report["results"][label] = await bench_size(path, size, args.number, args.repeat)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк горячих путей БД")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="размеры баз через запятую: 1k,100k,1m")
+    parser.add_argument("--number", type=int, default=200, help="вызовов в раунде для точечных операций")
+    parser.add_argument("--repeat", type=int, default=5, help="сколько раундов")
+    parser.add_argument("--workdir", default=str(Path(tempfile.gettempdir()) / "corpus-db-bench"))
+    parser.add_argument("--regenerate", action="store_true", help="пересоздать синтетические базы")
+    parser.add_argument("--json", help="сохранить результат в JSON")
+    parser.add_argument("--baseline", help="сравнить с эталоном (JSON от --save-baseline)")
+    parser.add_argument("--save-baseline", help="сохранить результат как эталон")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление, доля (0.25 = +25%%)")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            Path(path).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("\nregressions:", ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
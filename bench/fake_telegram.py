@@ -0,0 +1,192 @@
+"""
+Фейковый Telegram Bot API для нагрузочного теста.
+
+Отдаёт апдейты через getUpdates (long polling, как настоящий) и запоминает всё,
+что бот отправляет: sendMessage / sendMediaGroup / sendInvoice / deleteMessages и т.д.
+На остальные методы отвечает `true`, чтобы бот не падал на служебных вызовах.
+
+Бот направляется сюда переменной окружения TELEGRAM_API_URL=http://127.0.0.1:<port>.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "CORPUS bench", "username": "corpus_bench_bot"}
+
+
+class FakeTelegram:
+    """
+    Сервер + очередь апдейтов + журнал вызовов.
+    api_latency — искусственная задержка ответа на каждый вызов (имитация RTT до Telegram).
+    """
+
+    def __init__(self, api_latency: float = 0.0):
+        self.api_latency = api_latency
+        self.calls = []  # (monotonic time, method, chat_id или id запроса, params)
+        self.calls_by_method = defaultdict(int)
+
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._pending = deque()  # неподтверждённые апдейты
+        self._has_updates = asyncio.Event()
+        self._delivered_at = {}  # update_id -> когда бот впервые его забрал
+        self._waiters = defaultdict(list)  # key (см. wait_for) -> [(predicate, future)]
+
+        self.polling = asyncio.Event()  # бот сделал первый getUpdates — значит, поднялся
+        self.star_transactions = []  # ответ getStarTransactions: StarTransaction в виде dict, по порядку
+        self._runner: web.AppRunner | None = None
+
+    # ---------- сервер ----------
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._read_params(request)
+
+        if self.api_latency and method != "getUpdates":
+            await asyncio.sleep(self.api_latency)
+
+        handler = getattr(self, f"_api_{method}", None)
+        result = await handler(params) if handler else self._record(method, params, True)
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    async def _read_params(request: web.Request) -> dict:
+        """PTB шлёт form-data (сложные поля — JSON-строкой), наш BotApiClient — JSON."""
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str) and value[:1] in "[{":
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    # ---------- апдейты ----------
+    def push_update(self, payload: dict) -> int:
+        """Положить апдейт в очередь getUpdates. payload — всё, кроме update_id."""
+        update_id = next(self._update_ids)
+        self._pending.append({"update_id": update_id, **payload})
+        self._has_updates.set()
+        return update_id
+
+    def delivered_at(self, update_id: int) -> float | None:
+        return self._delivered_at.get(update_id)
+
+    async def _api_getUpdates(self, params: dict):
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+
+        # всё, что меньше offset, бот подтвердил
+        while self._pending and self._pending[0]["update_id"] < offset:
+            self._pending.popleft()
+
+        if not self._pending and timeout:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        batch = list(itertools.islice(self._pending, limit))
+        now = time.monotonic()
+        for upd in batch:
+            self._delivered_at.setdefault(upd["update_id"], now)
+        return batch
+
+    # ---------- ответы бота ----------
+    def wait_for(self, key, predicate) -> asyncio.Future:
+        """
+        Future, которое завершится временем первого вызова, подходящего под predicate(method, params).
+        key — chat_id, а для ответов на запросы без чата (answerPreCheckoutQuery) — id запроса.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[key].append((predicate, fut))
+        return fut
+
+    @staticmethod
+    def _call_key(params: dict):
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            return int(chat_id)
+        return params.get("pre_checkout_query_id") or params.get("callback_query_id")
+
+    def _record(self, method: str, params: dict, result=None):
+        now = time.monotonic()
+        key = self._call_key(params)
+        self.calls.append((now, method, key, params))
+        self.calls_by_method[method] += 1
+
+        waiters = self._waiters.get(key)
+        if waiters:
+            for item in list(waiters):
+                predicate, fut = item
+                if fut.done():
+                    waiters.remove(item)
+                elif predicate(method, params):
+                    fut.set_result(now)
+                    waiters.remove(item)
+        return result
+
+    def _message(self, params: dict, **extra) -> dict:
+        chat_id = int(params["chat_id"])
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    async def _api_getMe(self, params):
+        return self._record("getMe", params, BOT_USER)
+
+    async def _api_sendMessage(self, params):
+        return self._record("sendMessage", params, self._message(params, text=params.get("text", "")))
+
+    async def _api_sendVideo(self, params):
+        return self._record("sendVideo", params, self._message(params))
+
+    async def _api_sendInvoice(self, params):
+        return self._record("sendInvoice", params, self._message(params))
+
+    async def _api_createInvoiceLink(self, params):
+        return self._record("createInvoiceLink", params, f"https://t.me/$fake-invoice-{params.get('payload', '')}")
+
+    async def _api_getStarTransactions(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        return self._record(
+            "getStarTransactions", params, {"transactions": self.star_transactions[offset : offset + limit]}
+        )
+
+    async def _api_sendMediaGroup(self, params):
+        media = params.get("media") or []
+        return self._record("sendMediaGroup", params, [self._message(params) for _ in media])
+
+    async def _api_copyMessages(self, params):
+        message_ids = params.get("message_ids") or []
+        return self._record(
+            "copyMessages", params, [{"message_id": next(self._message_ids)} for _ in message_ids]
+        )
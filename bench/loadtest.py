@@ -0,0 +1,294 @@
+"""
+Нагрузочный тест бота целиком: настоящий bot.py (main(), все хендлеры, БД, job queue)
+поднимается отдельным процессом и ходит в фейковый Bot API (fake_telegram.py) — без сети.
+
+Каждый виртуальный пользователь проходит путь:
+    /start → ✅Подписка → pre_checkout → successful_payment
+    → 🏋🏽‍♀️Тренировка → В зале → 1 месяц → 1
+
+Кнопка тарифа — готовая ссылка на оплату: счёт открывается в клиенте без апдейта боту,
+поэтому после меню подписки сразу идёт pre_checkout.
+
+Шаг считается выполненным, когда бот ответил на него: сообщение с клавиатурой,
+счёт (sendInvoice) или answerPreCheckoutQuery. Задержка шага — от момента, когда бот
+забрал апдейт через getUpdates, до этого ответа.
+
+    python bench/loadtest.py --users 300 --concurrency 100
+    python bench/loadtest.py --users 300 --shards 4 --api-latency-ms 40 --json result.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+
+BENCH_TOKEN = "123456:BENCH"
+FIRST_USER_ID = 7_000_000_000  # подальше от DEV_USER_IDS и реальных пользователей
+BOT_START_TIMEOUT = 60
+
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", BENCH_TOKEN)
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+import bot  # noqa: E402  (только ради текстов кнопок и тарифов — чтобы не разъезжались с ботом)
+
+_message_ids = itertools.count(1)
+
+
+# ====== АПДЕЙТЫ ======
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"bench{user_id}", "username": f"bench{user_id}"}
+
+
+def _message(user_id: int, **fields) -> dict:
+    return {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        **fields,
+    }
+
+
+def text_update(user_id: int, text: str) -> dict:
+    fields = {"text": text}
+    if text.startswith("/"):
+        fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": _message(user_id, **fields)}
+
+
+def precheckout_update(user_id: int, plan_key: str) -> dict:
+    plan = bot.SUBSCRIPTION_PLANS[plan_key]
+    return {
+        "pre_checkout_query": {
+            "id": f"bench-pcq-{user_id}",
+            "from": _user(user_id),
+            "currency": "XTR",
+            "total_amount": plan["price"],
+            "invoice_payload": plan["payload"],
+        }
+    }
+
+
+def payment_update(user_id: int, plan_key: str) -> dict:
+    plan = bot.SUBSCRIPTION_PLANS[plan_key]
+    return {
+        "message": _message(
+            user_id,
+            successful_payment={
+                "currency": "XTR",
+                "total_amount": plan["price"],
+                "invoice_payload": plan["payload"],
+                "telegram_payment_charge_id": f"bench-charge-{user_id}",
+                "provider_payment_charge_id": "",
+            },
+        )
+    }
+
+
+# (название шага, апдейт, ключ ожидания ответа — chat_id или id pre_checkout_query)
+JOURNEY = [
+    ("start", lambda uid: text_update(uid, "/start"), lambda uid: uid),
+    ("subscription", lambda uid: text_update(uid, "✅Подписка"), lambda uid: uid),
+    ("precheckout", lambda uid: precheckout_update(uid, "month"), lambda uid: f"bench-pcq-{uid}"),
+    ("payment", lambda uid: payment_update(uid, "month"), lambda uid: uid),
+    ("training_menu", lambda uid: text_update(uid, "🏋🏽‍♀️Тренировка"), lambda uid: uid),
+    ("place", lambda uid: text_update(uid, "В зале"), lambda uid: uid),
+    ("month", lambda uid: text_update(uid, "1 месяц"), lambda uid: uid),
+    ("training", lambda uid: text_update(uid, "1"), lambda uid: uid),
+]
+
+
+def is_step_reply(method: str, params: dict) -> bool:
+    """Последний ответ бота на шаг пути."""
+    if method in ("sendInvoice", "answerPreCheckoutQuery"):
+        return True
+    return method == "sendMessage" and "reply_markup" in params
+
+
+# ====== СТАТИСТИКА ======
+def percentile(values: list[float], p: float) -> float:
+    """Перцентиль методом ближайшего ранга; values — отсортированный список."""
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[k]
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)  # шаг -> [секунды]
+        self.timeouts = defaultdict(int)
+        self.started = None
+        self.finished = None
+
+    def observe(self, step: str, seconds: float):
+        self.latencies[step].append(seconds)
+
+    def summary(self) -> dict:
+        def describe(values):
+            values = sorted(values)
+            return {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+            }
+
+        all_values = [v for values in self.latencies.values() for v in values]
+        elapsed = (self.finished or time.monotonic()) - (self.started or time.monotonic())
+        return {
+            "updates": len(all_values),
+            "elapsed_s": round(elapsed, 2),
+            "updates_per_s": round(len(all_values) / elapsed, 1) if elapsed > 0 else 0.0,
+            "total": describe(all_values),
+            "steps": {step: describe(self.latencies[step]) for step, _, _ in JOURNEY if step in self.latencies},
+            "timeouts": dict(self.timeouts),
+        }
+
+
+# ====== ГЕНЕРАТОР ТРАФИКА ======
+async def run_journey(fake: FakeTelegram, user_id: int, results: Results, step_timeout: float):
+    for step, make_update, make_key in JOURNEY:
+        # ждём ответ раньше, чем кладём апдейт, — чтобы не пропустить быстрый ответ
+        reply = fake.wait_for(make_key(user_id), is_step_reply)
+        update_id = fake.push_update(make_update(user_id))
+        try:
+            replied_at = await asyncio.wait_for(reply, step_timeout)
+        except asyncio.TimeoutError:
+            results.timeouts[step] += 1
+            return
+        results.observe(step, replied_at - fake.delivered_at(update_id))
+
+
+async def run_load(fake: FakeTelegram, users: int, concurrency: int, step_timeout: float) -> Results:
+    results = Results()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(user_id):
+        async with slots:
+            await run_journey(fake, user_id, results, step_timeout)
+
+    results.started = time.monotonic()
+    async with asyncio.TaskGroup() as tg:
+        for i in range(users):
+            tg.create_task(one(FIRST_USER_ID + i))
+    results.finished = time.monotonic()
+    return results
+
+
+# ====== ЗАПУСК БОТА ======
+async def start_bot(api_url: str, workdir: Path, shards: int) -> asyncio.subprocess.Process:
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BENCH_TOKEN,
+        "TELEGRAM_API_URL": api_url,
+        "BOT_DB_PATH": str(workdir / "bench.db"),
+        "BOT_SHARDS": str(shards),
+        "PYTHONUNBUFFERED": "1",
+    }
+    log = open(workdir / "bot.log", "wb")
+    return await asyncio.create_subprocess_exec(
+        sys.executable,
+        str(ROOT_DIR / "bot.py"),
+        cwd=str(ROOT_DIR),
+        env=env,
+        stdout=log,
+        stderr=asyncio.subprocess.STDOUT,
+    )
+
+
+async def stop_bot(proc: asyncio.subprocess.Process):
+    if proc.returncode is not None:
+        return
+    proc.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(proc.wait(), 30)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+
+async def wait_bot_ready(fake: FakeTelegram, proc: asyncio.subprocess.Process):
+    ready = asyncio.create_task(fake.polling.wait())
+    exited = asyncio.create_task(proc.wait())
+    done, _ = await asyncio.wait({ready, exited}, timeout=BOT_START_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+    ready.cancel()
+    exited.cancel()
+    if ready not in done:
+        raise RuntimeError("бот не начал опрашивать getUpdates")
+
+
+async def main_async(args) -> dict:
+    fake = FakeTelegram(api_latency=args.api_latency_ms / 1000)
+    api_url = await fake.start()
+    workdir = Path(tempfile.mkdtemp(prefix="corpus-bench-"))
+    proc = await start_bot(api_url, workdir, args.shards)
+
+    try:
+        try:
+            await wait_bot_ready(fake, proc)
+        except RuntimeError as e:
+            raise SystemExit(f"{e}, лог: {workdir / 'bot.log'}")
+
+        results = await run_load(fake, args.users, args.concurrency, args.step_timeout)
+    finally:
+        await stop_bot(proc)
+        await fake.close()
+
+    summary = results.summary()
+    summary["config"] = {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "shards": args.shards,
+        "api_latency_ms": args.api_latency_ms,
+    }
+    summary["api_calls"] = dict(fake.calls_by_method)
+    summary["bot_log"] = str(workdir / "bot.log")
+    return summary
+
+
+def print_summary(summary: dict):
+    cfg = summary["config"]
+    print(
+        f"users={cfg['users']} concurrency={cfg['concurrency']} shards={cfg['shards']} "
+        f"api_latency={cfg['api_latency_ms']}ms"
+    )
+    print(f"{'step':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, row in [*summary["steps"].items(), ("TOTAL", summary["total"])]:
+        print(f"{step:<16}{row['count']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    print(f"\n{summary['updates']} updates in {summary['elapsed_s']}s → {summary['updates_per_s']} updates/s")
+    if summary["timeouts"]:
+        print("timeouts:", summary["timeouts"])
+    print("api calls:", ", ".join(f"{m}={n}" for m, n in sorted(summary["api_calls"].items())))
+    print("bot log:", summary["bot_log"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота против фейкового Bot API")
+    parser.add_argument("--users", type=int, default=200, help="сколько виртуальных пользователей пройдут путь")
+    parser.add_argument("--concurrency", type=int, default=50, help="сколько пользователей идут одновременно")
+    parser.add_argument("--shards", type=int, default=1, help="BOT_SHARDS для бота")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="задержка ответа фейкового API")
+    parser.add_argument("--step-timeout", type=float, default=30.0, help="сколько ждать ответа на шаг, сек")
+    parser.add_argument("--json", help="сохранить результат в JSON-файл")
+    args = parser.parse_args()
+
+    summary = asyncio.run(main_async(args))
+    print_summary(summary)
+    if args.json:
+        Path(args.json).write_text(json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
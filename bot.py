@@ -1,6 +1,8 @@
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
     InputMediaVideo,
     LabeledPrice,
 )
@@ -11,17 +13,45 @@ from telegram.ext import (
     ContextTypes,
     filters,
     PreCheckoutQueryHandler,
+    CallbackQueryHandler,
 )
-from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
+from telegram.constants import MediaGroupLimit, MessageLimit
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
 
 from pathlib import Path
 
-from datetime import datetime, date, timezone, timedelta
-import sqlite3
+from datetime import datetime, date, time as dt_time, timezone, timedelta
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import hashlib
+import heapq
+import json
 import aiohttp
 import asyncio
+import logging
 import os
+import signal
+import sys
+import threading
+import time
 from content_data import VIDEO_IDS, TRAINING_TEXTS, MONTH_DESCRIPTIONS
+from storage import Storage, epoch_day, from_epoch_day, open_storage
+import logs
+import metrics
+import profiling
+import reconcile
+from loop_monitor import LoopMonitor
+from catalog import Catalog, merge_uploads, slot_label
+from handover import PollingLease, instance_id
+from update_lanes import LaneUpdateProcessor
+
+log = logging.getLogger("bot")
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# пишем в лог каждый N-й обработанный апдейт (все — слишком шумно под нагрузкой)
+LOG_UPDATE_SAMPLE = int(os.getenv("LOG_UPDATE_SAMPLE", "100"))
+LOG_BULK_FAILURE_SAMPLE = int(os.getenv("LOG_BULK_FAILURE_SAMPLE", "20"))
 
 TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
@@ -39,12 +69,17 @@ else:
     DB_DIR = BASE_DIR
 
 DB_DIR.mkdir(parents=True, exist_ok=True)
-DB_PATH = DB_DIR / "subscriptions.db"
-
-print(">>> DB_PATH =", DB_PATH.resolve())
+# BOT_DB_PATH — явный путь к файлу БД (например, отдельная база для нагрузочного теста в bench/)
+DB_PATH = Path(os.getenv("BOT_DB_PATH") or DB_DIR / "subscriptions.db")
 
 ADMIN_CHAT_ID = 503160725  # твой Telegram ID
 
+# ====== ШАРДИРОВАНИЕ ======
+# BOT_SHARDS > 1 — запускаем N процессов-воркеров, каждый обслуживает свою часть user_id
+# (user_id % BOT_SHARDS). Приём апдейтов и маршрутизация — в sharding.py.
+SHARD_COUNT = int(os.getenv("BOT_SHARDS", "1"))
+SHARD_ID = 0  # выставляется в процессе-воркере
+
 
 # ====== НАСТРОЙКИ ПОДПИСКИ / TELEGRAM STARS ======
 SUBSCRIPTION_YEAR_PAYLOAD = "corpus_subscription_year_v1"
@@ -80,59 +115,286 @@ SUBSCRIPTION_PAYLOAD = SUBSCRIPTION_YEAR_PAYLOAD
 SUBSCRIPTION_PRICE_STARS = SUBSCRIPTION_YEAR_PRICE_STARS
 
 
-def revoke_subscription(user_id: int):
-    """
-    Удаляем/отключаем подписку для пользователя.
-    После этого user_has_subscription(user_id) должен вернуть False.
-    """
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+# ====== ОБЩИЙ HTTP-КЛИЕНТ ДЛЯ ПРЯМЫХ ВЫЗОВОВ BOT API ======
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", "32"))
+BOT_API_TIMEOUT_SECONDS = float(os.getenv("BOT_API_TIMEOUT_SECONDS", "15"))
+BOT_API_MAX_RETRIES = 3
 
-    # Вариант 1 — полностью удалить подписку
-    cur.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
 
-    # Если у тебя другая таблица/столбцы — поправь название таблицы и поля.
-    # Например:
-    # cur.execute("UPDATE subscriptions SET end = ? WHERE user_id = ?", ("1970-01-01", user_id))
+class BotApiError(Exception):
+    """Telegram ответил ok=false на прямой вызов Bot API."""
 
-    conn.commit()
-    conn.close()
+    def __init__(self, method: str, description: str | None, error_code: int | None = None):
+        super().__init__(f"{method}: {error_code} {description}")
+        self.method = method
+        self.description = description
+        self.error_code = error_code
 
 
-def init_db():
-    """Создаём файл БД и таблицы, если их ещё нет."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+class BotApiClient:
+    """
+    Один aiohttp.ClientSession на всё приложение: пул соединений с keep-alive,
+    общий таймаут и повторы на 429 / 5xx / сетевых ошибках.
+    Неидемпотентные методы (idempotent=False, например refundStarPayment) повторяются только там,
+    где запрос точно не выполнен: 429 и ошибка соединения до отправки.
+    Открывается в post_init, закрывается в post_shutdown.
+    """
 
-    # таблица подписок
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            user_id INTEGER PRIMARY KEY,
-            start_date TEXT NOT NULL,
-            end_date   TEXT NOT NULL
+    def __init__(
+        self,
+        pool_size: int = BOT_API_POOL_SIZE,
+        timeout: float = BOT_API_TIMEOUT_SECONDS,
+        max_retries: int = BOT_API_MAX_RETRIES,
+    ):
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._session: aiohttp.ClientSession | None = None
+        self._base_url: str | None = None
+
+    async def start(self, base_url: str):
+        """base_url берём у бота (https://api.telegram.org/bot<token>), а не собираем руками."""
+        if self._session is not None:
+            return
+        self._base_url = base_url.rstrip("/")
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._pool_size, keepalive_timeout=60, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=self._timeout),
         )
-        """
-    )
 
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_seen TEXT NOT NULL,
-            last_seen  TEXT NOT NULL,
-            starts_count INTEGER NOT NULL DEFAULT 0,
-            trainings_opened INTEGER NOT NULL DEFAULT 0
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def call(self, method: str, *, idempotent: bool = True, **params):
+        """Вызов метода Bot API. Возвращает поле result или бросает BotApiError."""
+        if self._session is None:
+            raise RuntimeError("BotApiClient не запущен (ожидается start() в post_init)")
+
+        url = f"{self._base_url}/{method}"
+        for attempt in range(self._max_retries + 1):
+            last_attempt = attempt == self._max_retries
+            started = time.perf_counter()
+            try:
+                async with self._session.post(url, json=params) as resp:
+                    status = resp.status
+                    data = await resp.json(content_type=None)
+            except aiohttp.ClientConnectorError:
+                # соединение не установлено — запрос до Telegram не дошёл, повторять безопасно всегда
+                metrics.observe_api_call(method, time.perf_counter() - started)
+                if last_attempt:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # запрос мог выполниться, а потерялся только ответ
+                metrics.observe_api_call(method, time.perf_counter() - started)
+                if last_attempt or not idempotent:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+                continue
+            except ValueError:
+                # не JSON — HTML-страница 502 от прокси и т.п.: как 5xx
+                metrics.observe_api_call(method, time.perf_counter() - started)
+                if last_attempt or not idempotent:
+                    raise BotApiError(method, "non-JSON response", status)
+                await asyncio.sleep(2 ** attempt)
+                continue
+            metrics.observe_api_call(method, time.perf_counter() - started)
+
+            if data.get("ok"):
+                return data.get("result")
+
+            error_code = data.get("error_code")
+            if not last_attempt and error_code == 429:
+                retry_after = (data.get("parameters") or {}).get("retry_after", 1)
+                await asyncio.sleep(retry_after)
+                continue
+            if not last_attempt and idempotent and error_code and error_code >= 500:
+                await asyncio.sleep(2 ** attempt)
+                continue
+
+            raise BotApiError(method, data.get("description"), error_code)
+
+
+BOT_API = BotApiClient()
+
+
+# ====== ХРАНИЛИЩЕ ======
+# STORAGE_BACKEND=sqlite (по умолчанию, файл DB_PATH) или postgres (DATABASE_URL) — см. storage.py
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+
+STORAGE: Storage | None = None
+
+
+async def open_db() -> Storage:
+    global STORAGE
+    if STORAGE is None:
+        STORAGE = await open_storage(
+            STORAGE_BACKEND,
+            sqlite_path=DB_PATH,
+            database_url=DATABASE_URL,
+            pool_min_size=DB_POOL_MIN_SIZE,
+            pool_max_size=DB_POOL_MAX_SIZE,
         )
-        """
-    )
+        # время каждого вызова хранилища — в метрики (и в счётчик «время в БД» текущего апдейта)
+        for name in Storage.REPOS:
+            metrics.instrument_repo(getattr(STORAGE, name), name)
+    return STORAGE
+
+
+async def close_db():
+    global STORAGE
+    if STORAGE is not None:
+        await STORAGE.close()
+        STORAGE = None
+
+
+async def init_db():
+    """Открываем хранилище, создаём таблицы и проводим миграции, если нужно."""
+    storage = await open_db()
+    await storage.init_schema()
+
+
+async def migrate_db():
+    """Разовая миграция до старта воркеров (многопроцессный режим)."""
+    await init_db()
+    await close_db()
+
+
+# ====== КЕШ АКТИВНЫХ ПОДПИСЧИКОВ ======
+def today_epoch_day() -> int:
+    """Сегодняшний epoch-day без создания datetime/date."""
+    return int(time.time() // 86400)
+
+
+HEAP_COMPACT_SLACK = 1024  # чтобы маленькая куча не пересобиралась на каждой записи
+
+
+class ActiveSubscribers:
+    """
+    Активные подписчики в памяти: user_id -> epoch-day окончания (включительно)
+    + min-куча (end_day, user_id) для вытеснения истёкших.
+    Проверка доступа — одно membership без парсинга дат и без похода в БД.
+    Строится при старте из subscriptions и обновляется на каждой записи подписки.
+    """
+
+    def __init__(self):
+        self._end_day: dict[int, int] = {}
+        self._heap: list[tuple[int, int]] = []  # ленивое удаление: устаревшие пары просто пропускаем
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def load(self, rows):
+        """rows — пары (user_id, end_day)."""
+        with self._lock:
+            self._end_day = {}
+            self._heap = []
+            today = today_epoch_day()
+            for user_id, end_day in rows:
+                if end_day >= today:
+                    self._end_day[user_id] = end_day
+                    self._heap.append((end_day, user_id))
+            heapq.heapify(self._heap)
+            self.loaded = True
+
+    def set(self, user_id: int, end_day: int):
+        with self._lock:
+            if end_day < today_epoch_day():
+                self._end_day.pop(user_id, None)
+                return
+            self._end_day[user_id] = end_day
+            self._push(end_day, user_id)
+
+    def discard(self, user_id: int):
+        with self._lock:
+            self._end_day.pop(user_id, None)
+
+    def set_many(self, rows):
+        """rows — пары (user_id, end_day); блокировка берётся один раз на всю пачку."""
+        today = today_epoch_day()
+        with self._lock:
+            for user_id, end_day in rows:
+                if end_day < today:
+                    self._end_day.pop(user_id, None)
+                    continue
+                self._end_day[user_id] = end_day
+                self._push(end_day, user_id)
+
+    def discard_many(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._end_day.pop(user_id, None)
+
+    def _push(self, end_day: int, user_id: int):
+        """Под self._lock. Продления оставляют в куче устаревшие пары с будущей датой — они сами
+        не вытесняются, поэтому, когда мусора становится больше живых записей, пересобираем кучу."""
+        heapq.heappush(self._heap, (end_day, user_id))
+        if len(self._heap) > 2 * len(self._end_day) + HEAP_COMPACT_SLACK:
+            self._heap = [(day, uid) for uid, day in self._end_day.items()]
+            heapq.heapify(self._heap)
+
+    def _expire(self, today: int):
+        with self._lock:
+            while self._heap and self._heap[0][0] < today:
+                end_day, user_id = heapq.heappop(self._heap)
+                if self._end_day.get(user_id) == end_day:
+                    del self._end_day[user_id]
+
+    def __contains__(self, user_id: int) -> bool:
+        heap = self._heap
+        if heap:
+            today = today_epoch_day()
+            if heap[0][0] < today:
+                self._expire(today)
+        return user_id in self._end_day
+
+    def __len__(self) -> int:
+        return len(self._end_day)
+
+
+ACTIVE_SUBS = ActiveSubscribers()
+
+
+SUBSCRIPTION_CHANGES_SYNC_SECONDS = 2
+SUBSCRIPTION_CHANGES_RETENTION_SECONDS = 3600
+_subscription_changes_seen = 0
+
+
+async def sync_subscription_changes_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Подписку могли выдать/отозвать в другом процессе (например, /grant ушёл в шард админа).
+    Подтягиваем свежие изменения в локальный ACTIVE_SUBS.
+    """
+    global _subscription_changes_seen
+
+    rows = await STORAGE.subscriptions.changes_after(_subscription_changes_seen)
+    for change_id, user_id, end_day in rows:
+        if end_day is None:
+            ACTIVE_SUBS.discard(user_id)
+        else:
+            ACTIVE_SUBS.set(user_id, end_day)
+        _subscription_changes_seen = change_id
+
+
+async def prune_subscription_changes_job(context: ContextTypes.DEFAULT_TYPE):
+    await STORAGE.subscriptions.prune_changes(int(time.time()) - SUBSCRIPTION_CHANGES_RETENTION_SECONDS)
 
-    conn.commit()
-    conn.close()
 
+async def revoke_subscription(user_id: int):
+    """
+    Удаляем/отключаем подписку для пользователя.
+    После этого user_has_subscription(user_id) должен вернуть False.
+    """
+    await STORAGE.subscriptions.delete(user_id)
+    ACTIVE_SUBS.discard(user_id)
 
-def track_user_event(
+
+async def track_user_event(
     user_id: int,
     username: str | None = None,
     is_start: bool = False,
@@ -144,134 +406,46 @@ def track_user_event(
     - счётчик стартов
     - счётчик открытых тренировок
     """
-    now_iso = datetime.now(timezone.utc).isoformat()
-
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    # есть ли уже пользователь
-    cur.execute("SELECT first_seen, last_seen, starts_count, trainings_opened FROM users WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-
-    if row is None:
-        # новый пользователь
-        starts = 1 if is_start else 0
-        trainings = 1 if opened_training else 0
-        cur.execute(
-            """
-            INSERT INTO users (user_id, username, first_seen, last_seen, starts_count, trainings_opened)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (user_id, username, now_iso, now_iso, starts, trainings),
-        )
-    else:
-        first_seen, last_seen, starts_count, trainings_opened = row
-        if is_start:
-            starts_count += 1
-        if opened_training:
-            trainings_opened += 1
-
-        cur.execute(
-            """
-            UPDATE users
-            SET username = COALESCE(?, username),
-                last_seen = ?,
-                starts_count = ?,
-                trainings_opened = ?
-            WHERE user_id = ?
-            """,
-            (username, now_iso, starts_count, trainings_opened, user_id),
-        )
+    await STORAGE.users.track_event(user_id, username, is_start=is_start, opened_training=opened_training)
 
-    conn.commit()
-    conn.close()
 
-
-def load_subscription(user_id: int):
+async def load_subscription(user_id: int):
     """Забрать подписку пользователя из БД. Возвращает dict или None."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT start_date, end_date FROM subscriptions WHERE user_id = ?",
-        (user_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
+    return await STORAGE.subscriptions.get(user_id)
 
-    if not row:
-        return None
 
-    start = date.fromisoformat(row[0])
-    end = date.fromisoformat(row[1])
-    return {"start": start, "end": end}
-
-
-def save_subscription(user_id: int, start, end):
-    """Сохранить/обновить подписку пользователя в БД."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO subscriptions (user_id, start_date, end_date)
-        VALUES (?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            start_date = excluded.start_date,
-            end_date   = excluded.end_date
-        """,
-        (user_id, start.isoformat(), end.isoformat()),
-    )
-    conn.commit()
-    conn.close()
+async def extend_subscription(user_id: int, days: int) -> dict:
+    """
+    Продлить подписку на days дней: активную — от даты окончания, истёкшую или новую — от сегодня.
+    Чтение и запись — одна транзакция save_many под блокировкой пользователя: оплата и /grant
+    (или две оплаты) одновременно не затирают дни друг друга.
+    """
+    rows = await STORAGE.subscriptions.save_many([user_id], bulk_plan("extend", {user_id: days}, today_epoch_day()))
+    _, start_day, end_day = rows[0]
+    ACTIVE_SUBS.set(user_id, end_day)
+    return {"start": from_epoch_day(start_day), "end": from_epoch_day(end_day)}
 
 
-def create_or_extend_subscription(user_id: int, days: int = SUBSCRIPTION_DURATION_DAYS) -> dict:
+async def create_or_extend_subscription(user_id: int, days: int = SUBSCRIPTION_DURATION_DAYS) -> dict:
     """
     Создаём или продлеваем подписку на заданное количество дней.
     Если подписка ещё действует — продлеваем от даты окончания.
     Если уже истекла или не было — считаем от сегодняшней даты.
     """
-    today = datetime.now(timezone.utc).date()
-    current = load_subscription(user_id)
-
-    if current and current["end"] >= today:
-        # продлеваем от текущей даты окончания
-        new_start = current["start"]
-        new_end = current["end"] + timedelta(days=days)
-    else:
-        # новая или просроченная
-        new_start = today
-        new_end = today + timedelta(days=days)
-
-    save_subscription(user_id, new_start, new_end)
-    return {"start": new_start, "end": new_end}
+    return await extend_subscription(user_id, days)
 
 
 # ====== РУЧНАЯ ВЫДАЧА ПОДПИСКИ АДМИНОМ ======
-def manual_grant_subscription(user_id: int, days: int = SUBSCRIPTION_DURATION_DAYS):
+async def manual_grant_subscription(user_id: int, days: int = SUBSCRIPTION_DURATION_DAYS):
     """
     Выдать или продлить подписку пользователю вручную (например, без оплаты).
     Если подписка ещё активна — продлеваем от даты окончания.
     Если истекла или её не было — считаем от сегодня.
     """
-    today = datetime.now(timezone.utc).date()
-    sub = load_subscription(user_id)  # уже существующая функция, читает из БД
-
-    if sub and sub["end"] >= today:
-        # уже есть активная подписка — продлеваем от даты окончания
-        start = sub["start"]
-        end = sub["end"] + timedelta(days=days)
-    else:
-        # новой/просроченная — создаём с нуля от сегодня
-        start = today
-        end = today + timedelta(days=days)
-
-    # ⚠️ ВАЖНО: save_subscription принимает только 3 аргумента
-    save_subscription(user_id, start, end)
+    return await extend_subscription(user_id, days)
 
-    return {"start": start, "end": end}
 
-
-def user_has_subscription(user_id: int) -> bool:
+async def user_has_subscription(user_id: int) -> bool:
     """
     Активна ли подписка на сегодня.
     DEV_USER_IDS считаем всегда с активной подпиской.
@@ -279,46 +453,25 @@ def user_has_subscription(user_id: int) -> bool:
     if user_id in DEV_USER_IDS:
         return True
 
-    sub = load_subscription(user_id)
-    if not sub:
+    if ACTIVE_SUBS.loaded:
+        return user_id in ACTIVE_SUBS
+
+    end_day = await STORAGE.subscriptions.end_day(user_id)
+    if end_day is None:
         return False
 
-    today = datetime.now(timezone.utc).date()
-    return today <= sub["end"]
+    return today_epoch_day() <= end_day
 
 
-def get_subscription_dates(user_id: int):
+async def get_subscription_dates(user_id: int):
     """Вернуть (start_date, end_date) или (None, None)."""
-    sub = load_subscription(user_id)
+    sub = await load_subscription(user_id)
     if not sub:
         return None, None
     return sub["start"], sub["end"]
 
-def ensure_payments_table(cur: sqlite3.Cursor):
-    """Ensure payments table exists with plan metadata columns."""
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            charge_id TEXT NOT NULL,
-            amount INTEGER NOT NULL,
-            currency TEXT NOT NULL,
-            paid_at TEXT NOT NULL,
-            plan_key TEXT,
-            duration_days INTEGER
-        )
-        """
-    )
-
-    cols = {row[1] for row in cur.execute("PRAGMA table_info(payments)").fetchall()}
-    if "plan_key" not in cols:
-        cur.execute("ALTER TABLE payments ADD COLUMN plan_key TEXT")
-    if "duration_days" not in cols:
-        cur.execute("ALTER TABLE payments ADD COLUMN duration_days INTEGER")
-
 
-def save_payment(
+async def save_payment(
     user_id: int,
     charge_id: str,
     amount: int,
@@ -327,63 +480,42 @@ def save_payment(
     duration_days: int | None = None,
 ):
     """Persist payment info into the payments table."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    ensure_payments_table(cur)
-
-    cur.execute(
-        """
-        INSERT INTO payments (user_id, charge_id, amount, currency, paid_at, plan_key, duration_days)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            user_id,
-            charge_id,
-            amount,
-            currency,
-            datetime.now(timezone.utc).isoformat(),
-            plan_key,
-            duration_days,
-        ),
-    )
-    conn.commit()
-    conn.close()
+    await STORAGE.payments.save(user_id, charge_id, amount, currency, plan_key, duration_days)
+
 
-def cancel_subscription_in_db(user_id: int):
+async def cancel_subscription_in_db(user_id: int):
     """
     Обрезаем подписку пользователю (используем после рефанда).
-    Предполагаем, что есть таблица subscriptions с колонками (user_id, start_date, end_date).
     """
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE subscriptions
-        SET end_date = ?
-        WHERE user_id = ?
-        """,
-        (datetime.now(timezone.utc).date().isoformat(), user_id),
-    )
-    conn.commit()
-    conn.close()
+    today = datetime.now(timezone.utc).date()
+    if await STORAGE.subscriptions.cut(user_id, today):
+        ACTIVE_SUBS.set(user_id, epoch_day(today))
+
 
 async def refund_star_payment(user_id: int, charge_id: str) -> bool:
     """
     Делаем рефанд через Bot API: refundStarPayment.
-    Возвращает True, если Telegram сказал ok.
+    Возвращает True, если Telegram сказал ok или что платёж уже возвращён
+    (прошлый вызов прошёл, а ответ потерялся) — подписку в обоих случаях надо забрать.
     """
-    url = f"https://api.telegram.org/bot{TOKEN}/refundStarPayment"
-    payload = {
-        "user_id": user_id,
-        "telegram_payment_charge_id": charge_id,
-    }
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as resp:
-            data = await resp.json()
-            # При успехе Telegram вернёт {"ok": true, "result": true}
-            return data.get("ok") and data.get("result") is True
+    try:
+        result = await BOT_API.call(
+            "refundStarPayment",
+            idempotent=False,
+            user_id=user_id,
+            telegram_payment_charge_id=charge_id,
+        )
+    except BotApiError as e:
+        if "CHARGE_ALREADY_REFUNDED" in (e.description or ""):
+            log.info("charge already refunded", extra={"user_id": user_id, "charge_id": charge_id})
+            return True
+        log.warning("refundStarPayment failed", exc_info=e, extra={"user_id": user_id, "charge_id": charge_id})
+        return False
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.warning("refundStarPayment failed", exc_info=e, extra={"user_id": user_id, "charge_id": charge_id})
+        return False
+    # При успехе Telegram вернёт {"ok": true, "result": true}
+    return result is True
 
 # ====== КНОПКИ ======
 MAIN_MENU_BUTTONS = [
@@ -440,6 +572,14 @@ def kb_training_abc():
 
 
 def kb_subscription_plans():
+    # готовые ссылки на оплату (см. prewarm_invoice_links) — счёт открывается сразу, без запроса к боту
+    if all(key in INVOICE_LINKS for key in ("month", "year")):
+        return InlineKeyboardMarkup(
+            [
+                [InlineKeyboardButton(SUBSCRIPTION_MONTH_BUTTON, url=INVOICE_LINKS["month"])],
+                [InlineKeyboardButton(SUBSCRIPTION_YEAR_BUTTON, url=INVOICE_LINKS["year"])],
+            ]
+        )
     return ReplyKeyboardMarkup(
         [
             [SUBSCRIPTION_MONTH_BUTTON, SUBSCRIPTION_YEAR_BUTTON],
@@ -451,6 +591,8 @@ def kb_subscription_plans():
 
 # ====== СЛОВАРИ С ВИДЕО/ТЕКСТАМИ/ДОКУМЕНТАМИ ======
 # Данные вынесены в content_data.py, чтобы не держать file_id и тексты в основном файле.
+# Видео, загруженные через /ingest, лежат в БД и накладываются поверх VIDEO_IDS (catalog.py).
+CATALOG = Catalog(VIDEO_IDS)
 
 # ====== TERMS & PAY SUPPORT & DEV ======
 async def cmd_terms(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -480,7 +622,7 @@ async def cmd_devsub(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Эта команда только для разработчика бота.")
         return
 
-    sub = create_or_extend_subscription(user_id)
+    sub = await create_or_extend_subscription(user_id)
     start, end = sub["start"], sub["end"]
 
     await update.message.reply_text(
@@ -497,36 +639,14 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Эта команда только для администратора.")
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    # всего уникальных пользователей
-    cur.execute("SELECT COUNT(*) FROM users")
-    total_users = cur.fetchone()[0] or 0
-
-    # новые за последние 7 дней
-    cur.execute(
-        """
-        SELECT COUNT(*) FROM users
-        WHERE datetime(first_seen) >= datetime('now', '-7 days')
-        """
-    )
-    new_7d = cur.fetchone()[0] or 0
-
-    # кто открывал хоть одну тренировку
-    cur.execute("SELECT COUNT(*) FROM users WHERE trainings_opened > 0")
-    trained_users = cur.fetchone()[0] or 0
+    new_since = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
+    users_stats = await STORAGE.users.stats(new_since)
+    total_users = users_stats["total"]
+    new_7d = users_stats["new"]
+    trained_users = users_stats["trained"]
 
     # активные подписки
-    cur.execute(
-        """
-        SELECT COUNT(*) FROM subscriptions
-        WHERE date(end_date) >= date('now')
-        """
-    )
-    active_subs = cur.fetchone()[0] or 0
-
-    conn.close()
+    active_subs = await STORAGE.subscriptions.count_active(today_epoch_day())
 
     msg = (
         "📊 Статистика бота:\n\n"
@@ -536,6 +656,23 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"✅ Активных подписок: <b>{active_subs}</b>\n"
     )
 
+    latency = SEND_TRAINING_LATENCY.summary()
+    if latency:
+        msg += "\n⏱ Отправка тренировки (p50 / p95, мс):\n"
+        for stage, (count, p50, p95) in latency.items():
+            msg += f"• {stage}: {p50 * 1000:.0f} / {p95 * 1000:.0f} (n={count})\n"
+
+    lag = LOOP_MONITOR.summary()
+    if lag:
+        count, p50, p95, p99, worst = lag
+        msg += (
+            "\n🫀 Лаг event loop (p50 / p95 / p99 / max, мс):\n"
+            f"• {p50 * 1000:.0f} / {p95 * 1000:.0f} / {p99 * 1000:.0f} / {worst * 1000:.0f} (n={count})\n"
+        )
+        if LOOP_MONITOR.slow:
+            _, seconds, handler, _ = LOOP_MONITOR.slow[-1]
+            msg += f"• последнее зависание: {seconds * 1000:.0f} мс в {handler}\n"
+
     await update.message.reply_text(msg, parse_mode="HTML")
 
 # ====== /refund — рефанд платежа Stars + удаление подписки ======
@@ -578,26 +715,26 @@ async def cmd_refund(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # ---- если рефанд успешный — удаляем подписку в БД ----
+    # ---- если рефанд успешный — удаляем подписку в БД (и из кеша активных) ----
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-
-        # Таблица подписок subscriptions(user_id, start_date, end_date)
-        cur.execute("DELETE FROM subscriptions WHERE user_id = ?", (target_user_id,))
-        conn.commit()
-        conn.close()
+        await revoke_subscription(target_user_id)
     except Exception as e:
         await message.reply_text(f"Рефанд прошёл, но подписку удалить не удалось: {e}")
         return
 
+    # ---- рефанд — в журнал сверки Stars ----
+    try:
+        await STORAGE.ledger.record([("refund", charge_id, target_user_id, None, f"/refund by {admin_id}", "admin")])
+    except Exception as e:
+        logs.swallowed("cmd_refund.ledger", e)
+
     # ---- очищаем кеш user_data, если там был флаг подписки ----
     try:
         ud = context.application.user_data.get(target_user_id)
         if ud and "has_subscription" in ud:
             ud["has_subscription"] = False
-    except:
-        pass
+    except Exception as e:
+        logs.swallowed("cmd_refund.user_data", e)
 
     # ---- финальный ответ ----
     await message.reply_text(
@@ -606,6 +743,65 @@ async def cmd_refund(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"charge_id: {charge_id}"
     )
 
+# ====== СВЕРКА STARS С ТАБЛИЦЕЙ payments (см. reconcile.py) ======
+RECONCILE_TIME_UTC = dt_time(hour=int(os.getenv("RECONCILE_HOUR_UTC", "4")), tzinfo=timezone.utc)
+RECONCILE_KINDS = {
+    "missing_in_db": "оплачено, но платежа нет в БД",
+    "mismatch": "сумма/пользователь не совпадают",
+    "missing_in_telegram": "платёж в БД, но нет у Telegram",
+    "refund": "рефанды",
+}
+
+_reconcile_lock = asyncio.Lock()
+
+
+async def fetch_star_transactions(bot, offset: int, limit: int) -> list:
+    result = await bot.get_star_transactions(offset=offset, limit=limit)
+    return list(result.transactions)
+
+
+def format_reconcile_report(report: dict) -> str:
+    lines = [f"Сверка Stars: просмотрено транзакций {report['scanned']} (всего {report['offset']})"]
+    if not report["new"]:
+        lines.append("Новых расхождений нет ✅")
+        return "\n".join(lines)
+
+    lines.append("")
+    for kind, n in report["new"].items():
+        lines.append(f"{RECONCILE_KINDS.get(kind, kind)}: {n}")
+    lines.append("")
+    for entry in report["examples"]:
+        lines.append(
+            f"• {entry['kind']} user {entry['user_id']} {entry['amount'] or ''}⭐ {entry['charge_id']}"
+            + (f" ({entry['details']})" if entry["details"] else "")
+        )
+    return "\n".join(lines)
+
+
+async def run_reconcile(bot) -> dict:
+    async with _reconcile_lock:
+        return await reconcile.reconcile(STORAGE, lambda offset, limit: fetch_star_transactions(bot, offset, limit))
+
+
+async def reconcile_stars_job(context: ContextTypes.DEFAULT_TYPE):
+    """Раз в день; админу пишем, только если нашлось что-то новое."""
+    report = await run_reconcile(context.bot)
+    if report["new"]:
+        await context.bot.send_message(ADMIN_CHAT_ID, format_reconcile_report(report))
+
+
+async def cmd_reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in DEV_USER_IDS:
+        await update.message.reply_text("Эта команда только для администратора бота.")
+        return
+    if _reconcile_lock.locked():
+        await update.message.reply_text("Сверка уже идёт.")
+        return
+
+    report = await run_reconcile(context.bot)
+    await update.message.reply_text(format_reconcile_report(report))
+
+
 # ====== /subs — список всех подписок (ТОЛЬКО ДЛЯ АДМИНА) ======
 async def cmd_subs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_id = update.effective_user.id
@@ -613,49 +809,10 @@ async def cmd_subs(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Эта команда только для администратора.")
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    # таблица подписок
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            user_id INTEGER PRIMARY KEY,
-            start_date TEXT NOT NULL,
-            end_date TEXT NOT NULL
-        )
-    """)
-    
-    cur.execute("SELECT user_id, start_date, end_date FROM subscriptions ORDER BY user_id")
-    subs = cur.fetchall()
-
-    # таблица платежей (приводим к новой схеме с хранением тарифа)
-    ensure_payments_table(cur)
+    subs = await STORAGE.subscriptions.list_all()
 
     # берём последние платежи по каждому user_id
-    cur.execute("""
-        SELECT user_id, charge_id, amount, currency, paid_at, plan_key, duration_days
-        FROM payments
-        WHERE id IN (
-            SELECT MAX(id)
-            FROM payments
-            GROUP BY user_id
-        )
-    """)
-    payments_raw = cur.fetchall()
-
-    conn.close()
-
-    # превращаем платежи в удобный dict
-    last_payments = {}
-    for uid, charge_id, amount, currency, paid_at, plan_key, duration_days in payments_raw:
-        last_payments[uid] = {
-            "charge_id": charge_id,
-            "amount": amount,
-            "currency": currency,
-            "paid_at": paid_at,
-            "plan_key": plan_key,
-            "duration_days": duration_days,
-        }
+    last_payments = await STORAGE.payments.last_per_user()
 
     if not subs:
         await update.message.reply_text("Подписок пока нет.")
@@ -664,12 +821,12 @@ async def cmd_subs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # собираем текст
     msg_lines = ["📄 <b>Список подписок:</b>\n"]
 
-    today = datetime.now(timezone.utc).date()
+    today = today_epoch_day()
 
-    for user_id, start, end in subs:
-        start_d = datetime.fromisoformat(start).date()
-        end_d = datetime.fromisoformat(end).date()
-        is_active = "\U0001f7e2 Активна" if end_d >= today else "\U0001f534 Истекла"
+    for user_id, start_day, end_day in subs:
+        start_d = from_epoch_day(start_day)
+        end_d = from_epoch_day(end_day)
+        is_active = "\U0001f7e2 Активна" if end_day >= today else "\U0001f534 Истекла"
 
         payment_info = last_payments.get(user_id)
         plan_key = None
@@ -697,7 +854,7 @@ async def cmd_subs(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not plan_duration and plan_key in SUBSCRIPTION_PLANS:
                 plan_duration = SUBSCRIPTION_PLANS[plan_key]["duration_days"]
 
-        total_span_days = (end_d - start_d).days + 1
+        total_span_days = end_day - start_day + 1
         if not plan_key:
             if total_span_days >= SUBSCRIPTION_YEAR_DURATION_DAYS:
                 plan_key = "year"
@@ -771,7 +928,7 @@ async def cmd_grant(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         days = SUBSCRIPTION_DURATION_DAYS  # по умолчанию 365
 
-    sub = manual_grant_subscription(target_user_id, days)
+    sub = await manual_grant_subscription(target_user_id, days)
 
     await update.message.reply_text(
         "Подписка выдана/продлена вручную ✅\n"
@@ -804,7 +961,7 @@ async def cmd_revoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 🔴 Полностью убираем подписку из БД
     try:
-        revoke_subscription(target_user_id)  # <- использует твою функцию выше, которая делает DELETE FROM subscriptions
+        await revoke_subscription(target_user_id)  # <- использует твою функцию выше, которая делает DELETE FROM subscriptions
     except Exception as e:
         await update.message.reply_text(f"Не удалось забрать подписку: {e}")
         return
@@ -814,167 +971,1043 @@ async def cmd_revoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ud = context.application.user_data.get(target_user_id)
         if ud:
             ud.pop("has_subscription", None)
-    except Exception:
-        pass
+    except Exception as e:
+        logs.swallowed("cmd_revoke.user_data", e)
 
     await update.message.reply_text(
         "Подписка пользователя отозвана ✅\n"
         f"user_id: {target_user_id}"
     )
 
-# ====== /restart — перезапуск бота (ТОЛЬКО ДЛЯ АДМИНА) ======
-async def cmd_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if user_id not in DEV_USER_IDS:
-        await update.message.reply_text("Эта команда только для администратора бота.")
-        return
+# ====== /bulk — МАССОВАЯ ВЫДАЧА / ПРОДЛЕНИЕ / ОТЗЫВ ПОДПИСОК (ТОЛЬКО АДМИН) ======
+# Всё применяется одной транзакцией: либо все строки, либо ни одной.
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "50000"))
+BULK_MAX_FILE_BYTES = 2 * 1024 * 1024
+BULK_MODES = ("grant", "extend", "revoke")
+BULK_REPORT_ERRORS = 5
+
+BULK_USAGE = (
+    "Использование:\n"
+    "/bulk <grant|extend> <days> [user_id ...]\n"
+    "/bulk revoke [user_id ...]\n\n"
+    "extend — продлить на days (от даты окончания, если подписка активна, как /grant);\n"
+    "grant — подписка минимум до сегодня + days (уже более длинные не трогаем);\n"
+    "revoke — забрать подписку.\n\n"
+    "Вместо списка в сообщении можно прислать CSV-файл с этой командой в подписи "
+    "или ответить командой на такой файл. Строки: user_id[,days] — "
+    "days из строки важнее days из команды. Заголовок и пустые строки пропускаются."
+)
 
-    await update.message.reply_text("Перезапускаю бота…")
 
-    # даём сообщению улететь
-    await asyncio.sleep(1)
+def parse_bulk_items(text: str, default_days: int | None) -> tuple[list[tuple[int, int | None]], list[str]]:
+    """
+    Строки вида «user_id», «user_id,days», «user_id;days» или через пробел/таб.
+    Возвращает ([(user_id, days)], ошибки). Нечисловая первая строка считается заголовком.
+    """
+    items = []
+    errors = []
+    for line_no, line in enumerate(text.splitlines(), 1):
+        parts = line.replace(",", " ").replace(";", " ").split()
+        if not parts:
+            continue
+        try:
+            user_id = int(parts[0])
+            days = int(parts[1]) if len(parts) > 1 else default_days
+        except ValueError:
+            if line_no == 1:
+                continue  # заголовок CSV
+            errors.append(f"строка {line_no}: {line.strip()[:40]}")
+            continue
+        if user_id <= 0 or (days is not None and days <= 0):
+            errors.append(f"строка {line_no}: {line.strip()[:40]}")
+            continue
+        items.append((user_id, days))
+    return items, errors
+
+
+def merge_bulk_items(mode: str, items: list[tuple[int, int | None]]) -> dict[int, int | None]:
+    """Повторы одного user_id: extend — дни складываем, grant — берём максимум."""
+    merged: dict[int, int | None] = {}
+    for user_id, days in items:
+        if user_id not in merged or days is None:
+            merged[user_id] = days
+        elif mode == "extend":
+            merged[user_id] += days
+        else:
+            merged[user_id] = max(merged[user_id], days)
+    return merged
 
-    # жёстко выходим из процесса — Railway сам перезапустит контейнер
-    os._exit(1)
 
-# ====== START ======
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    track_user_event(user.id, user.username, is_start=True)
-    # сохраняем только дату последней тренировки
-    last_date = context.user_data.get("last_training_date")
-    context.user_data.clear()
-    if last_date:
-        context.user_data["last_training_date"] = last_date
+def bulk_plan(mode: str, merged: dict[int, int], today_day: int):
+    """compute для STORAGE.subscriptions.save_many: новые (user_id, start_day, end_day) по текущим подпискам."""
 
-    await update.message.reply_text(
-        "Добро пожаловать,\nCORPUS — платформа с продуманной системой тренировок, которая делает самостоятельные занятия безопасными и эффективными. Выберите нужный пункт меню 👇",
-        reply_markup=kb_main(),
-        protect_content=True,
-    )
+    def compute(existing: dict[int, tuple[int, int]]) -> list[tuple[int, int, int]]:
+        rows = []
+        for user_id, days in merged.items():
+            current = existing.get(user_id)
+            active = current is not None and current[1] >= today_day
+            if mode == "extend":
+                rows.append(
+                    (user_id, current[0], current[1] + days) if active else (user_id, today_day, today_day + days)
+                )
+            elif not active:
+                rows.append((user_id, today_day, today_day + days))
+            elif current[1] < today_day + days:
+                rows.append((user_id, current[0], today_day + days))
+            # grant: подписка и так длиннее — не трогаем
+        return rows
 
+    return compute
 
-# ====== ОТПРАВКА ИНВОЙСА НА ПОДПИСКУ ======
-async def send_subscription_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE, plan_key: str = "year"):
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
 
-    if user_has_subscription(user_id):
-        start_d, end_d = get_subscription_dates(user_id)
-        if start_d and end_d:
-            txt = (
-                "У Вас уже есть активная подписка ✅\n\n"
-                f"Начало: {start_d.strftime('%d.%m.%Y')}\n"
-                f"Окончание: {end_d.strftime('%d.%m.%Y')}\n\n"
-                "Можеште открывать любые тренировки."
-            )
-        else:
-            txt = (
-                "У Вас уже есть активная подписка ✅\n"
-                "Можете открывать любые тренировки."
-            )
+async def read_bulk_document(message, bot) -> str | None:
+    document = message.document if message is not None else None
+    if document is None:
+        return None
+    if document.file_size and document.file_size > BULK_MAX_FILE_BYTES:
+        raise ValueError(f"файл больше {BULK_MAX_FILE_BYTES // 1024} КБ")
+    tg_file = await bot.get_file(document.file_id)
+    data = await tg_file.download_as_bytearray()
+    return bytes(data).decode("utf-8-sig", errors="replace")
 
-        await update.message.reply_text(txt, reply_markup=kb_main())
+
+async def cmd_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if update.effective_user.id not in DEV_USER_IDS:
+        await message.reply_text("Эта команда только для администратора бота.")
         return
 
-    plan = SUBSCRIPTION_PLANS.get(plan_key, SUBSCRIPTION_PLANS["year"])
+    # у документа команда приходит в подписи — CommandHandler её не видит, аргументы режем сами
+    args = context.args if context.args is not None else (message.caption or "").split()[1:]
+    if not args or args[0].lower() not in BULK_MODES:
+        await message.reply_text(BULK_USAGE)
+        return
+    mode = args[0].lower()
+    args = args[1:]
 
-    prices = [
-        LabeledPrice(
-            label=plan["label"],
-            amount=plan["price"],
-        )
-    ]
+    default_days = None
+    if mode != "revoke":
+        if not args or not args[0].isdigit() or int(args[0]) <= 0:
+            await message.reply_text("days должен быть положительным числом.\n\n" + BULK_USAGE)
+            return
+        default_days = int(args[0])
+        args = args[1:]
+
+    try:
+        text = await read_bulk_document(message, context.bot)
+        if text is None:
+            text = await read_bulk_document(message.reply_to_message, context.bot)
+    except Exception as e:
+        await message.reply_text(f"Не удалось прочитать файл: {e}")
+        return
+    if text is None:
+        text = "\n".join(args)
+    else:
+        text += "\n" + "\n".join(args)
+
+    items, errors = parse_bulk_items(text, default_days)
+    if not items:
+        await message.reply_text("Не нашёл ни одного user_id.\n\n" + BULK_USAGE)
+        return
+    if len(items) > BULK_MAX_ROWS:
+        await message.reply_text(f"Слишком много строк: {len(items)} (максимум {BULK_MAX_ROWS}).")
+        return
+
+    merged = merge_bulk_items(mode, items)
+    started = time.perf_counter()
+    try:
+        if mode == "revoke":
+            changed = await STORAGE.subscriptions.delete_many(list(merged))
+            ACTIVE_SUBS.discard_many(changed)
+        else:
+            rows = await STORAGE.subscriptions.save_many(list(merged), bulk_plan(mode, merged, today_epoch_day()))
+            ACTIVE_SUBS.set_many((user_id, end_day) for user_id, _, end_day in rows)
+            changed = [user_id for user_id, _, _ in rows]
+    except Exception as e:
+        log.exception("bulk %s failed", mode, extra={"rows": len(merged)})
+        await message.reply_text(f"Ничего не применено, ошибка БД: {e}")
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    # кеш проверки подписки в user_data — чистим разом у всех затронутых
+    user_data = context.application.user_data
+    for user_id in changed:
+        ud = user_data.get(user_id)
+        if ud:
+            ud.pop("has_subscription", None)
 
-    await context.bot.send_invoice(
-        chat_id=chat_id,
-        title=plan["title"],
-        description=plan["description"],
-        payload=plan["payload"],
-        provider_token="",
-        currency="XTR",
-        prices=prices,
-        max_tip_amount=0,
+    log.info(
+        "bulk subscriptions applied",
+        extra={"mode": mode, "rows": len(merged), "changed": len(changed), "ms": round(elapsed_ms)},
     )
+    lines = [
+        f"/bulk {mode} ✅",
+        f"Строк: {len(items)}, уникальных user_id: {len(merged)}",
+    ]
+    if mode == "revoke":
+        lines.append(f"Отозвано: {len(changed)}, подписки не было: {len(merged) - len(changed)}")
+    else:
+        lines.append(f"Записано: {len(changed)}, без изменений: {len(merged) - len(changed)}")
+    if errors:
+        lines.append(f"Пропущено строк с ошибками: {len(errors)}")
+        lines.extend(errors[:BULK_REPORT_ERRORS])
+    lines.append(f"Транзакция: {elapsed_ms:.0f} мс")
+    await message.reply_text("\n".join(lines))
+
+
+# ====== /ingest + /publish — ЗАГРУЗКА ВИДЕО В КАТАЛОГ (ТОЛЬКО АДМИН) ======
+CATALOG_SYNC_SECONDS = 10
+INGEST_PLACES = {"gym": "В зале", "home": "Дома"}
+
+INGEST_USAGE = (
+    "Использование:\n"
+    "/ingest <place> <month> <training> — дальше присылай видео, они встанут в конец тренировки\n"
+    "/ingest replace <place> <month> <training> — тренировка соберётся заново только из новых видео\n"
+    "/ingest — что сейчас в черновике\n"
+    "/ingest stop — выйти из режима загрузки (черновик остаётся)\n"
+    "/ingest cancel — выйти и выбросить черновик\n"
+    "/publish — опубликовать черновик новой версией каталога\n\n"
+    "place: gym / home; month: 1, 2-3, 4-5, 6-7, 8-9, 10-12, trial; "
+    "training: 1–12 для 1 месяца, Ягодицы / Верх тела / Ноги для остальных.\n"
+    "Пример: /ingest gym 2-3 Верх тела"
+)
 
 
-# ====== ОБРАБОТКА ПЛАТЕЖА STARS ======
-async def precheckout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.pre_checkout_query
+def format_uploads(uploads: list[tuple]) -> list[str]:
+    counts = defaultdict(int)
+    replaced = set()
+    for place, month, training, _, replace in uploads:
+        counts[(place, month, training)] += 1
+        if replace:
+            replaced.add((place, month, training))
+    return [
+        f"• {slot_label(*slot)}: +{count}" + (" (заменит тренировку)" if slot in replaced else "")
+        for slot, count in counts.items()
+    ]
 
-    if query.invoice_payload not in PAYLOAD_TO_PLAN:
-        await query.answer(
-            ok=False,
-            error_message="Неизвестный платёж. Попробуйте ещё раз или напиши в /paysupport.",
-        )
-        return
 
-    await query.answer(ok=True)
+async def cmd_ingest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if update.effective_user.id not in DEV_USER_IDS:
+        await message.reply_text("Эта команда только для администратора бота.")
+        return
 
+    args = list(context.args)
+    if not args:
+        uploads = await STORAGE.catalog.uploads()
+        session = context.user_data.get("ingest")
+        lines = [f"Каталог: версия {CATALOG.version}"]
+        if session:
+            lines.append(f"Загрузка в: {slot_label(*session['slot'])}" + (" (замена)" if session["replace"] else ""))
+        if uploads:
+            lines.append(f"В черновике видео: {len(uploads)}")
+            lines.extend(format_uploads(uploads))
+        else:
+            lines.append("Черновик пуст.")
+        await message.reply_text("\n".join(lines) + "\n\n" + INGEST_USAGE)
+        return
 
-# ====== ОБРАБОТКА УСПЕШНОГО ПЛАТЕЖА STARS ======
-async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """
-    Вызывается автоматически, когда Telegram подтверждает успешный платёж Stars.
-    """
-    sp = update.message.successful_payment
-    user_id = update.effective_user.id
+    if args[0].lower() == "stop":
+        context.user_data.pop("ingest", None)
+        await message.reply_text("Режим загрузки выключен. Черновик сохранён — /publish, чтобы опубликовать.")
+        return
 
-    plan_key = PAYLOAD_TO_PLAN.get(sp.invoice_payload)
-    plan_duration = None
-    if plan_key and sp.currency == "XTR":
-        plan_duration = SUBSCRIPTION_PLANS[plan_key]["duration_days"]
+    if args[0].lower() == "cancel":
+        context.user_data.pop("ingest", None)
+        discarded = await STORAGE.catalog.discard_uploads()
+        await message.reply_text(f"Режим загрузки выключен, черновик очищен (видео: {discarded}).")
+        return
 
-    # ????????? ?????? ??? ?????????? ????????
-    save_payment(
-        user_id=user_id,
-        charge_id=sp.telegram_payment_charge_id,
-        amount=sp.total_amount,
-        currency=sp.currency,
-        plan_key=plan_key,
-        duration_days=plan_duration,
-    )
+    replace = args[0].lower() == "replace"
+    if replace:
+        args = args[1:]
+    if len(args) < 3:
+        await message.reply_text(INGEST_USAGE)
+        return
 
-    if sp.currency == "XTR" and plan_key:
-        plan = SUBSCRIPTION_PLANS[plan_key]
-        sub = create_or_extend_subscription(user_id, days=plan["duration_days"])
-        start, end = sub["start"], sub["end"]
+    place, month, training = args[0].lower(), args[1], " ".join(args[2:])
+    training = training[:1].upper() + training[1:]  # «верх тела» -> «Верх тела», как на кнопке
+    if place not in INGEST_PLACES or not CATALOG.has_slot(place, month, training):
+        await message.reply_text(f"Нет такой тренировки в меню: {slot_label(place, month, training)}\n\n" + INGEST_USAGE)
+        return
 
-        await update.message.reply_text(
-            "Оплата прошла успешно ✅\n"
-            "Ваша подписка активирована.\n\n"
-            f"Начало: {start.strftime('%d.%m.%Y')}\n"
-            f"Окончание: {end.strftime('%d.%m.%Y')}\n\n"
-            "Теперь Вам доступен полный набор тренировок и общий чат с лекциями по питанию, полезными материалами и поддержкой 💗\n\n"
-            "[вступить в чат](https://t.me/+AOT_lFEIZzo5NTNi)",
-            reply_markup=kb_main(),
-            parse_mode="Markdown",
-        )
-    else:
-        await update.message.reply_text(
-            "Получен неизвестный платёж. Напишите в /paysupport."
+    context.user_data["ingest"] = {"slot": (place, month, training), "replace": replace}
+    current = len(CATALOG.videos(place, month, training))
+    await message.reply_text(
+        f"Загрузка в {INGEST_PLACES[place]} / {month} / {training} 📥\n"
+        + (
+            f"Сейчас видео в тренировке: {current} — после /publish их заменят новые.\n"
+            if replace
+            else f"Сейчас видео в тренировке: {current}, новые встанут после них.\n"
         )
+        + "Присылай видео в нужном порядке (можно альбомом). Закончить — /ingest stop, опубликовать — /publish."
+    )
 
-# ====== ОСНОВНОЙ ХЕНДЛЕР ТЕКСТА ======
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
-    user = update.effective_user
-    user_id = user.id
-
-    # фиксируем любой визит / активность
-    track_user_event(user_id, user.username)
 
-    has_sub = user_has_subscription(user_id)
+async def ingest_video(update: Update, context: ContextTypes.DEFAULT_TYPE, session: dict):
+    """Видео от админа в режиме загрузки — в черновик каталога."""
+    video = update.message.video
+    if video is None:
+        await update.message.reply_text("В режиме загрузки принимаю только видео (не файлом).")
+        return
 
-    # возврат в меню
-    if text.lower() in ["меню", "вернуться в меню", "/меню", "/menu", "/вернуться в меню"]:
-        await start(update, context)
+    place, month, training = session["slot"]
+    duplicate = await STORAGE.catalog.add_upload(
+        place, month, training, video.file_id, video.file_unique_id, session["replace"], update.effective_user.id
+    )
+    if duplicate is not None:
+        await update.message.reply_text(f"⚠️ Это видео уже есть: {slot_label(*duplicate)} — пропускаю.")
         return
+    log.info(
+        "catalog upload",
+        extra={"slot": slot_label(place, month, training), "file_unique_id": video.file_unique_id},
+    )
+    await update.message.reply_text(f"✅ {slot_label(place, month, training)}: видео в черновике")
 
-    # Подписка
-    if text in ["✅Подписка", "Оформить подписку"]:
+
+async def cmd_publish(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    admin_id = update.effective_user.id
+    if admin_id not in DEV_USER_IDS:
+        await message.reply_text("Эта команда только для администратора бота.")
+        return
+
+    published = await STORAGE.catalog.publish(
+        lambda overlay, uploads: merge_uploads(VIDEO_IDS, overlay, uploads), admin_id
+    )
+    if published is None:
+        await message.reply_text("Черновик пуст — публиковать нечего.")
+        return
+
+    version, overlay, uploads = published
+    CATALOG.load(version, overlay)
+    context.user_data.pop("ingest", None)
+    log.info("catalog published", extra={"version": version, "videos": len(uploads), "admin_id": admin_id})
+    await message.reply_text(
+        f"Каталог опубликован ✅ версия {version}\n" + "\n".join(format_uploads(uploads))
+    )
+
+
+async def sync_catalog_job(context: ContextTypes.DEFAULT_TYPE):
+    """/publish мог пройти в другом процессе — подтягиваем новую версию каталога."""
+    if await STORAGE.catalog.latest_version() != CATALOG.version:
+        CATALOG.load(*await STORAGE.catalog.latest())
+    # тренировку могли перевыложить в канал из другого процесса (таблица маленькая — читаем целиком)
+    await reload_vault_index()
+
+
+# ====== МАССОВЫЕ ОТПРАВКИ: ОГРАНИЧЕНИЕ СКОРОСТИ ======
+# Telegram пускает ~30 сообщений в секунду на бота; оставляем запас под обычные ответы.
+BULK_SEND_RATE = float(os.getenv("BULK_SEND_RATE", "25"))
+BULK_SEND_MAX_ATTEMPTS = 3
+
+
+class RateLimiter:
+    """Token bucket: не больше rate отправок в секунду суммарно на всех воркеров."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+BULK_SEND_LIMITER = RateLimiter(BULK_SEND_RATE)
+
+
+async def send_bulk_message(bot, chat_id: int, text: str, **kwargs) -> str:
+    """
+    Отправка одного сообщения из массовой рассылки через общий лимитер.
+    Возвращает "delivered", "blocked" (бот заблокирован / чат недоступен) или "failed".
+    """
+    for attempt in range(BULK_SEND_MAX_ATTEMPTS):
+        await BULK_SEND_LIMITER.acquire()
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+            return "delivered"
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            await asyncio.sleep(retry_after)
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "blocked"
+            log.warning(
+                "bulk send failed: %s",
+                e,
+                extra={"event": "bulk_send_failed", "chat_id": chat_id, "sample": LOG_BULK_FAILURE_SAMPLE},
+            )
+            return "failed"
+        except (TimedOut, NetworkError):
+            await asyncio.sleep(2 ** attempt)
+    log.warning(
+        "bulk send gave up after %d attempts",
+        BULK_SEND_MAX_ATTEMPTS,
+        extra={"event": "bulk_send_failed", "chat_id": chat_id, "sample": LOG_BULK_FAILURE_SAMPLE},
+    )
+    return "failed"
+
+
+async def run_send_pool(items: list, send_one, workers: int) -> dict:
+    """
+    Прогнать items через пул воркеров. send_one(item) — корутина, возвращающая
+    результат send_bulk_message. Возвращает счётчики delivered / blocked / failed.
+    """
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+    counts = defaultdict(int)
+
+    async def worker():
+        while not queue.empty():
+            item = queue.get_nowait()
+            try:
+                result = await send_one(item)
+            except Exception as e:
+                # неожиданная ошибка на одном получателе не должна отменять остальных воркеров
+                logs.swallowed("run_send_pool", e)
+                result = "failed"
+            counts[result] += 1
+
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(min(workers, len(items))):
+            tg.create_task(worker())
+
+    return counts
+
+
+# ====== /broadcast — рассылка по базе (ТОЛЬКО ДЛЯ АДМИНА) ======
+BROADCAST_BATCH_SIZE = 200
+BROADCAST_WORKERS = 8
+BROADCAST_AUDIENCES = {"all", "subs"}
+
+
+async def run_broadcast(bot, broadcast_id: int):
+    """
+    Рассылка порциями: курсор по user_id → пул воркеров через общий лимитер → чекпоинт в БД.
+    После рестарта продолжаем с last_user_id (в худшем случае повторно уйдёт одна порция).
+    """
+    broadcast = await STORAGE.broadcasts.get(broadcast_id)
+    if not broadcast or broadcast["status"] != "running":
+        return
+
+    # запускается через create_task: упавшую рассылку иначе никто не заметит до рестарта
+    try:
+        await send_broadcast_batches(bot, broadcast_id, broadcast)
+    except Exception as e:
+        log.exception("broadcast failed", extra={"event": "broadcast_failed", "broadcast_id": broadcast_id})
+        try:
+            await STORAGE.broadcasts.fail(broadcast_id)
+            await bot.send_message(
+                broadcast["admin_chat_id"],
+                f"Рассылка #{broadcast_id} остановилась из-за ошибки ❌\n\n"
+                f"{type(e).__name__}: {e}\n"
+                "Часть получателей могла не получить сообщение — подробности в логах.",
+            )
+        except Exception as report_err:
+            logs.swallowed("run_broadcast_report", report_err)
+
+
+async def send_broadcast_batches(bot, broadcast_id: int, broadcast: dict):
+    last_user_id = broadcast["last_user_id"]
+
+    while True:
+        ids = await STORAGE.users.recipient_ids(
+            last_user_id,
+            BROADCAST_BATCH_SIZE,
+            subscribers_only=broadcast["audience"] == "subs",
+            today_day=today_epoch_day(),
+        )
+        if not ids:
+            break
+
+        counts = await run_send_pool(
+            ids,
+            lambda uid: send_bulk_message(bot, uid, broadcast["text"]),
+            BROADCAST_WORKERS,
+        )
+
+        last_user_id = ids[-1]
+        await STORAGE.broadcasts.checkpoint(broadcast_id, last_user_id, counts)
+
+        if SHUTTING_DOWN:
+            # бот останавливается: статус остаётся running, после старта продолжим с чекпоинта
+            log.info("broadcast paused for shutdown", extra={"broadcast_id": broadcast_id, "last_user_id": last_user_id})
+            return
+
+    await STORAGE.broadcasts.checkpoint(broadcast_id, last_user_id, {}, finished=True)
+
+    result = await STORAGE.broadcasts.get(broadcast_id)
+    await bot.send_message(
+        result["admin_chat_id"],
+        f"Рассылка #{broadcast_id} завершена ✅\n\n"
+        f"Доставлено: {result['delivered']}\n"
+        f"Заблокировали бота: {result['blocked']}\n"
+        f"Ошибки: {result['failed']}",
+    )
+
+
+async def resume_broadcasts_job(context: ContextTypes.DEFAULT_TYPE):
+    """После рестарта дожимаем незавершённые рассылки."""
+    for broadcast_id in await STORAGE.broadcasts.unfinished_ids():
+        context.application.create_task(run_broadcast(context.bot, broadcast_id))
+
+
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admin_id = update.effective_user.id
+    if admin_id not in DEV_USER_IDS:
+        await update.message.reply_text("Эта команда только для администратора бота.")
+        return
+
+    # берём сырой текст, чтобы не потерять переносы строк
+    parts = update.message.text.split(maxsplit=2)
+    if len(parts) < 3 or parts[1] not in BROADCAST_AUDIENCES:
+        await update.message.reply_text(
+            "Использование:\n"
+            "/broadcast <all|subs> <текст>\n\n"
+            "all — все пользователи бота,\n"
+            "subs — только с активной подпиской."
+        )
+        return
+
+    audience, text = parts[1], parts[2]
+    broadcast_id = await STORAGE.broadcasts.create(update.effective_chat.id, audience, text)
+    context.application.create_task(run_broadcast(context.bot, broadcast_id))
+
+    await update.message.reply_text(
+        f"Рассылка #{broadcast_id} запущена 📣\n"
+        f"Аудитория: {audience}\n"
+        "Итоги пришлю, когда закончу."
+    )
+
+# ====== НАПОМИНАНИЯ ОБ ОКОНЧАНИИ ПОДПИСКИ ======
+EXPIRY_REMINDER_DAYS = int(os.getenv("EXPIRY_REMINDER_DAYS", "3"))
+EXPIRY_SWEEP_TIME_UTC = dt_time(hour=int(os.getenv("EXPIRY_SWEEP_HOUR_UTC", "9")), tzinfo=timezone.utc)
+EXPIRY_SWEEP_WORKERS = 4
+
+
+def kb_renew():
+    def button(text: str, plan_key: str) -> InlineKeyboardButton:
+        if plan_key in INVOICE_LINKS:
+            return InlineKeyboardButton(text, url=INVOICE_LINKS[plan_key])
+        return InlineKeyboardButton(text, callback_data=f"renew:{plan_key}")
+
+    return InlineKeyboardMarkup(
+        [
+            [button(SUBSCRIPTION_MONTH_BUTTON, "month")],
+            [button(SUBSCRIPTION_YEAR_BUTTON, "year")],
+        ]
+    )
+
+
+async def send_expiry_reminder(bot, user_id: int, end_date: str) -> str:
+    # запись идемпотентности: по одной подписке напоминаем один раз
+    if not await STORAGE.subscriptions.claim_reminder(user_id, end_date):
+        return "skipped"
+
+    end_d = date.fromisoformat(end_date)
+    result = await send_bulk_message(
+        bot,
+        user_id,
+        f"Ваша подписка CORPUS заканчивается {end_d.strftime('%d.%m.%Y')} ⏳\n\n"
+        "Продлите её, чтобы не потерять доступ к тренировкам 👇",
+        reply_markup=kb_renew(),
+    )
+    if result == "failed":
+        # отправка не удалась (не блокировка) — снимаем отметку, попробуем на следующем проходе
+        await STORAGE.subscriptions.release_reminder(user_id, end_date)
+    return result
+
+
+async def expiry_sweeper_job(context: ContextTypes.DEFAULT_TYPE):
+    """Раз в день: напомнить всем, у кого подписка заканчивается в ближайшие EXPIRY_REMINDER_DAYS дней."""
+    # range scan по индексу end_day: кто заканчивается в [сегодня; сегодня + N] и кому ещё не напоминали
+    today = today_epoch_day()
+    rows = await STORAGE.subscriptions.expiring_unreminded(today, today + EXPIRY_REMINDER_DAYS)
+    if not rows:
+        return
+
+    await run_send_pool(
+        rows,
+        lambda row: send_expiry_reminder(context.bot, row[0], row[1]),
+        EXPIRY_SWEEP_WORKERS,
+    )
+
+
+async def renew_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка «продлить» из напоминания — сразу выставляем счёт (продление идёт от даты окончания)."""
+    query = update.callback_query
+    await query.answer()
+
+    plan_key = query.data.split(":", 1)[1]
+    await send_plan_invoice(context.bot, query.message.chat_id, plan_key)
+
+
+# ====== ПЕРЕДАЧА ПОЛЛИНГА ПРИ ДЕПЛОЕ ======
+# новый инстанс забирает getUpdates у старого без окна простоя — см. handover.py
+POLLING_LEASE_NAME = "polling"
+POLLING_LEASE_TTL_SECONDS = float(os.getenv("POLLING_LEASE_TTL_SECONDS", "15"))
+POLLING_LEASE_HEARTBEAT_SECONDS = float(os.getenv("POLLING_LEASE_HEARTBEAT_SECONDS", "3"))
+
+POLLING_LEASE: PollingLease | None = None
+
+
+def make_polling_lease(storage: Storage) -> PollingLease:
+    return PollingLease(
+        storage.leases,
+        POLLING_LEASE_NAME,
+        instance_id(),
+        ttl=POLLING_LEASE_TTL_SECONDS,
+        heartbeat=POLLING_LEASE_HEARTBEAT_SECONDS,
+    )
+
+
+async def acquire_polling_lease(application: Application):
+    """Вызывается в конце post_init: кеши уже прогреты, дальше сразу начнётся поллинг."""
+    global POLLING_LEASE
+    POLLING_LEASE = make_polling_lease(STORAGE)
+    await POLLING_LEASE.acquire()
+
+    async def on_handover():
+        # отдельной задачей: остановка сама отпустит аренду через POLLING_LEASE.release()
+        application.create_task(shutdown_gracefully(application))
+
+    POLLING_LEASE.start_heartbeat(on_handover)
+
+
+async def release_polling_lease():
+    if POLLING_LEASE is not None:
+        await POLLING_LEASE.release()
+
+
+# ====== ПЛАВНАЯ ОСТАНОВКА ======
+# порядок: перестаём забирать апдейты → дожидаемся хендлеров (не дольше RESTART_DRAIN_SECONDS) →
+# сохраняем отложенные удаления сообщений → PTB останавливает джобы и задачи → post_shutdown
+# закрывает HTTP-клиенты и хранилище. Если что-то зависло — через SHUTDOWN_HARD_DEADLINE_SECONDS
+# выходим жёстко.
+RESTART_DRAIN_SECONDS = float(os.getenv("RESTART_DRAIN_SECONDS", "20"))
+SHUTDOWN_HARD_DEADLINE_SECONDS = float(os.getenv("SHUTDOWN_HARD_DEADLINE_SECONDS", "60"))
+RESTART_EXIT_CODE = 1  # ненулевой код — Railway сам поднимет контейнер заново
+RESTART_MARKER_KEY = "restart"
+PENDING_DELETES_SWEEP_SECONDS = 30
+
+SHUTTING_DOWN = False  # длинные циклы (рассылка) проверяют флаг и выходят на ближайшем чекпоинте
+RESTART_REQUESTED = False
+
+
+def arm_hard_deadline(exit_code: int):
+    """Страховка: если плавная остановка где-то повисла, процесс всё равно завершится."""
+    timer = threading.Timer(SHUTDOWN_HARD_DEADLINE_SECONDS, os._exit, args=(exit_code,))
+    timer.daemon = True
+    timer.start()
+
+
+async def drain_updates(application: Application, timeout: float) -> float:
+    """Ждём, пока разберут очередь апдейтов и допишут хендлеры в работе. Возвращает, сколько ждали."""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        pending = getattr(application.update_processor, "pending", 0)
+        if application.update_queue.empty() and not pending and metrics.HANDLER_IN_FLIGHT.total() <= 0:
+            break
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - started
+
+
+async def persist_pending_deletes(application: Application) -> int:
+    """Таймеры удаления тренировок живут в JobQueue — сохраняем их в БД, чтобы пережили рестарт."""
+    if not application.job_queue:
+        return 0
+    rows = []
+    for job in application.job_queue.jobs():
+        if job.callback is not delete_message_job or job.next_t is None:
+            continue
+        rows.append((job.data["chat_id"], job.data["message_ids"], int(job.next_t.timestamp())))
+        job.schedule_removal()
+    await STORAGE.runtime.save_pending_deletes(rows)
+    return len(rows)
+
+
+async def restore_pending_deletes(application: Application) -> int:
+    if not application.job_queue:
+        return 0
+    rows = await STORAGE.runtime.take_pending_deletes()
+    if rows and SHUTTING_DOWN:
+        # свой JobQueue вот-вот остановится — возвращаем, заберёт следующий инстанс
+        await STORAGE.runtime.save_pending_deletes(rows)
+        return 0
+    now = time.time()
+    for chat_id, message_ids, delete_at in rows:
+        application.job_queue.run_once(
+            delete_message_job,
+            when=max(delete_at - now, 0),
+            data={"chat_id": chat_id, "message_ids": message_ids},
+        )
+    return len(rows)
+
+
+async def sweep_pending_deletes_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Старый инстанс при деплое сохраняет часть таймеров уже после передачи аренды (и после нашего
+    старта) — периодически подбираем их, иначе видео останутся в чате до следующего рестарта.
+    """
+    if SHUTTING_DOWN:
+        return
+    restored = await restore_pending_deletes(context.application)
+    if restored:
+        log.info("pending deletes picked up", extra={"pending_deletes": restored})
+
+
+async def prepare_shutdown(application: Application) -> float:
+    """Общая часть остановки для одиночного процесса и воркера-шарда. Возвращает время дренажа."""
+    global SHUTTING_DOWN
+    SHUTTING_DOWN = True
+
+    # новые апдейты больше не забираем (у воркера-шарда апдейтера нет — их перестаёт слать ingress)
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+    # таймеры удаления — в БД до того, как отдать аренду: новый инстанс заберёт их сразу на старте
+    saved = await persist_pending_deletes(application)
+    # offset уже подтверждён — новый инстанс может поллить, пока мы дорабатываем полученное
+    await release_polling_lease()
+
+    drained = await drain_updates(application, RESTART_DRAIN_SECONDS)
+    # таймеры хендлеров, доработанных после передачи аренды, новый инстанс подберёт sweep-джобой
+    saved += await persist_pending_deletes(application)
+    log.info(
+        "drained before shutdown",
+        extra={
+            "drain_ms": round(drained * 1000),
+            "in_flight": metrics.HANDLER_IN_FLIGHT.total(),
+            "pending_deletes": saved,
+        },
+    )
+    return drained
+
+
+async def shutdown_gracefully(application: Application, restart_chat_id: int | None = None):
+    """SIGTERM/SIGINT или /restart в одиночном процессе. run_polling после stop_running доделает остальное."""
+    global RESTART_REQUESTED
+    if SHUTTING_DOWN:
+        return
+    RESTART_REQUESTED = restart_chat_id is not None
+    requested_at = time.time()
+    arm_hard_deadline(RESTART_EXIT_CODE if RESTART_REQUESTED else 0)
+
+    drained = await prepare_shutdown(application)
+
+    if RESTART_REQUESTED:
+        await STORAGE.runtime.set_value(
+            RESTART_MARKER_KEY,
+            json.dumps(
+                {
+                    "chat_id": restart_chat_id,
+                    "requested_at": requested_at,
+                    "drain_seconds": round(drained, 3),
+                    "stopped_at": time.time(),
+                }
+            ),
+        )
+    application.stop_running()
+
+
+async def report_restart(application: Application):
+    """Первый старт после /restart: рассказываем админу, сколько занял перезапуск."""
+    raw = await STORAGE.runtime.pop_value(RESTART_MARKER_KEY)
+    if not raw:
+        return
+    marker = json.loads(raw)
+    now = time.time()
+    total = now - marker["requested_at"]
+
+    text = f"Бот перезапущен ✅\n\nВсего: {total:.1f} с"
+    if "drain_seconds" in marker:
+        text += f"\nДоработка апдейтов: {marker['drain_seconds']:.1f} с"
+    if "stopped_at" in marker:
+        text += f"\nПростой (остановка → готов): {now - marker['stopped_at']:.1f} с"
+    log.info("restart completed", extra={"restart_ms": round(total * 1000)})
+    try:
+        await application.bot.send_message(marker["chat_id"], text)
+    except Exception as e:
+        logs.swallowed("report_restart", e, log)
+
+
+def install_stop_signals(application: Application):
+    """Вместо стандартных сигналов run_polling — наша остановка с дренажом."""
+    if sys.platform.startswith("win"):
+        return
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: application.create_task(shutdown_gracefully(application)))
+
+
+# ====== /restart — перезапуск бота (ТОЛЬКО ДЛЯ АДМИНА) ======
+async def cmd_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in DEV_USER_IDS:
+        await update.message.reply_text("Эта команда только для администратора бота.")
+        return
+
+    if SHUTTING_DOWN:
+        await update.message.reply_text("Бот уже останавливается.")
+        return
+
+    await update.message.reply_text(
+        f"Перезапускаю бота: дожидаюсь текущих апдейтов (до {RESTART_DRAIN_SECONDS:.0f} с) и сохраняю состояние…"
+    )
+
+    if SHARD_COUNT > 1:
+        # воркер сам себя не перезапустит: просим ingress-процесс остановить всех и выйти с кодом рестарта
+        await STORAGE.runtime.set_value(
+            RESTART_MARKER_KEY,
+            json.dumps({"chat_id": update.effective_chat.id, "requested_at": time.time()}),
+        )
+        os.kill(os.getppid(), signal.SIGHUP)
+        return
+
+    # отдельной задачей: хендлер должен завершиться, иначе дренаж будет ждать сам себя
+    context.application.create_task(
+        shutdown_gracefully(context.application, restart_chat_id=update.effective_chat.id)
+    )
+
+# ====== /profile — профилирование живого бота (ТОЛЬКО ДЛЯ АДМИНА) ======
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+
+
+async def run_profile(bot, chat_id: int, mode: str, seconds: int):
+    files = await profiling.run(mode, seconds)
+    shard = f", шард {SHARD_ID}" if SHARD_COUNT > 1 else ""
+    for filename, data in files:
+        await bot.send_document(chat_id, document=data, filename=filename, caption=f"{mode}, {seconds} с{shard}")
+
+
+async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /profile [секунды] [sample|cprofile]
+    sample (по умолчанию) — сэмплирование стеков, почти без накладных расходов, collapsed stacks;
+    cprofile — точный профиль event loop в .pstats, но бот в это время заметно медленнее.
+    """
+    user_id = update.effective_user.id
+    if user_id not in DEV_USER_IDS:
+        await update.message.reply_text("Эта команда только для администратора бота.")
+        return
+
+    seconds = PROFILE_DEFAULT_SECONDS
+    mode = "sample"
+    for arg in context.args:
+        if arg.isdigit():
+            seconds = min(max(int(arg), 1), PROFILE_MAX_SECONDS)
+        elif arg in ("sample", "cprofile"):
+            mode = arg
+        else:
+            await update.message.reply_text(
+                "Использование:\n"
+                "/profile [секунды] [sample|cprofile]\n\n"
+                f"По умолчанию: {PROFILE_DEFAULT_SECONDS} с, sample. Максимум {PROFILE_MAX_SECONDS} с."
+            )
+            return
+
+    if profiling.is_running():
+        await update.message.reply_text("Профиль уже снимается, дождитесь результата.")
+        return
+
+    await update.message.reply_text(f"Снимаю профиль ({mode}) {seconds} с, пришлю файлы…")
+    # в фоне — хендлер не должен держать обработку апдейтов всё это время
+    context.application.create_task(run_profile(context.bot, update.effective_chat.id, mode, seconds))
+
+
+# ====== START ======
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    await track_user_event(user.id, user.username, is_start=True)
+    # сохраняем только дату последней тренировки
+    last_date = context.user_data.get("last_training_date")
+    context.user_data.clear()
+    if last_date:
+        context.user_data["last_training_date"] = last_date
+
+    await update.message.reply_text(
+        "Добро пожаловать,\nCORPUS — платформа с продуманной системой тренировок, которая делает самостоятельные занятия безопасными и эффективными. Выберите нужный пункт меню 👇",
+        reply_markup=kb_main(),
+        protect_content=True,
+    )
+
+
+# ====== ОТПРАВКА ИНВОЙСА НА ПОДПИСКУ ======
+async def send_subscription_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE, plan_key: str = "year"):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+
+    if await user_has_subscription(user_id):
+        start_d, end_d = await get_subscription_dates(user_id)
+        if start_d and end_d:
+            txt = (
+                "У Вас уже есть активная подписка ✅\n\n"
+                f"Начало: {start_d.strftime('%d.%m.%Y')}\n"
+                f"Окончание: {end_d.strftime('%d.%m.%Y')}\n\n"
+                "Можеште открывать любые тренировки."
+            )
+        else:
+            txt = (
+                "У Вас уже есть активная подписка ✅\n"
+                "Можете открывать любые тренировки."
+            )
+
+        await update.message.reply_text(txt, reply_markup=kb_main())
+        return
+
+    await send_plan_invoice(context.bot, chat_id, plan_key)
+
+
+def plan_invoice_params(plan: dict) -> dict:
+    """Общие параметры счёта для send_invoice и create_invoice_link."""
+    return {
+        "title": plan["title"],
+        "description": plan["description"],
+        "payload": plan["payload"],
+        "provider_token": "",
+        "currency": "XTR",
+        "prices": [LabeledPrice(label=plan["label"], amount=plan["price"])],
+        "max_tip_amount": 0,
+    }
+
+
+async def send_plan_invoice(bot, chat_id: int, plan_key: str):
+    """Выставить счёт в Stars на выбранный тариф."""
+    plan = SUBSCRIPTION_PLANS.get(plan_key, SUBSCRIPTION_PLANS["year"])
+    await bot.send_invoice(chat_id=chat_id, **plan_invoice_params(plan))
+
+
+# ====== ГОТОВЫЕ ССЫЛКИ НА ОПЛАТУ ======
+# Ссылка от createInvoiceLink одна на тариф и подходит любому пользователю: кнопка-ссылка открывает
+# счёт прямо в клиенте, бот на нажатие ничего не делает. Ссылки храним в БД вместе с отпечатком
+# тарифа — поменяли цену/описание в SUBSCRIPTION_PLANS, при старте ссылка пересоздастся.
+INVOICE_LINK_KEY = "invoice_link:{plan_key}"
+
+INVOICE_LINKS: dict[str, str] = {}
+
+
+def plan_fingerprint(plan: dict) -> str:
+    fields = {key: plan[key] for key in ("payload", "price", "label", "title", "description")}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:16]
+
+
+async def prewarm_invoice_links(bot):
+    for plan_key, plan in SUBSCRIPTION_PLANS.items():
+        key = INVOICE_LINK_KEY.format(plan_key=plan_key)
+        fingerprint = plan_fingerprint(plan)
+
+        raw = await STORAGE.runtime.get_value(key)
+        cached = json.loads(raw) if raw else None
+        if cached and cached["fingerprint"] == fingerprint:
+            INVOICE_LINKS[plan_key] = cached["url"]
+            continue
+
+        try:
+            url = await bot.create_invoice_link(**plan_invoice_params(plan))
+        except Exception as e:
+            # без ссылки меню работает по-старому: кнопки → send_invoice
+            INVOICE_LINKS.pop(plan_key, None)
+            logs.swallowed("prewarm_invoice_links", e, log)
+            continue
+
+        await STORAGE.runtime.set_value(key, json.dumps({"fingerprint": fingerprint, "url": url}))
+        INVOICE_LINKS[plan_key] = url
+        log.info("invoice link created", extra={"plan": plan_key, "fingerprint": fingerprint})
+
+
+# ====== ОБРАБОТКА ПЛАТЕЖА STARS ======
+async def precheckout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.pre_checkout_query
+
+    if query.invoice_payload not in PAYLOAD_TO_PLAN:
+        await query.answer(
+            ok=False,
+            error_message="Неизвестный платёж. Попробуйте ещё раз или напиши в /paysupport.",
+        )
+        return
+
+    await query.answer(ok=True)
+
+
+# ====== ОБРАБОТКА УСПЕШНОГО ПЛАТЕЖА STARS ======
+async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Вызывается автоматически, когда Telegram подтверждает успешный платёж Stars.
+    """
+    sp = update.message.successful_payment
+    user_id = update.effective_user.id
+
+    plan_key = PAYLOAD_TO_PLAN.get(sp.invoice_payload)
+    plan_duration = None
+    if plan_key and sp.currency == "XTR":
+        plan_duration = SUBSCRIPTION_PLANS[plan_key]["duration_days"]
+
+    # ????????? ?????? ??? ?????????? ????????
+    await save_payment(
+        user_id=user_id,
+        charge_id=sp.telegram_payment_charge_id,
+        amount=sp.total_amount,
+        currency=sp.currency,
+        plan_key=plan_key,
+        duration_days=plan_duration,
+    )
+
+    if sp.currency == "XTR" and plan_key:
+        plan = SUBSCRIPTION_PLANS[plan_key]
+        sub = await create_or_extend_subscription(user_id, days=plan["duration_days"])
+        start, end = sub["start"], sub["end"]
+
+        await update.message.reply_text(
+            "Оплата прошла успешно ✅\n"
+            "Ваша подписка активирована.\n\n"
+            f"Начало: {start.strftime('%d.%m.%Y')}\n"
+            f"Окончание: {end.strftime('%d.%m.%Y')}\n\n"
+            "Теперь Вам доступен полный набор тренировок и общий чат с лекциями по питанию, полезными материалами и поддержкой 💗\n\n"
+            "[вступить в чат](https://t.me/+AOT_lFEIZzo5NTNi)",
+            reply_markup=kb_main(),
+            parse_mode="Markdown",
+        )
+    else:
+        await update.message.reply_text(
+            "Получен неизвестный платёж. Напишите в /paysupport."
+        )
+
+# ====== ОСНОВНОЙ ХЕНДЛЕР ТЕКСТА ======
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    user = update.effective_user
+    user_id = user.id
+
+    # фиксируем любой визит / активность
+    await track_user_event(user_id, user.username)
+
+    has_sub = await user_has_subscription(user_id)
+
+    # возврат в меню
+    if text.lower() in ["меню", "вернуться в меню", "/меню", "/menu", "/вернуться в меню"]:
+        await start(update, context)
+        return
+
+    # Подписка
+    if text in ["✅Подписка", "Оформить подписку"]:
         if has_sub:
-            start_d, end_d = get_subscription_dates(user_id)
+            start_d, end_d = await get_subscription_dates(user_id)
             if start_d and end_d:
                 msg = (
                     "У Вас уже есть активная подписка ✅\n\n"
@@ -1224,22 +2257,192 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+# ====== ПЛАН ОТПРАВКИ ТРЕНИРОВКИ ======
+TRAINING_TTL_SECONDS = 86400  # тренировка удаляется через 24 часа
+
+TRAINING_FOOTER_TEXT = (
+    "<b><i>Тренировка автоматически удалится через 24 часа</i></b>\n\n"
+    "Можешь вернуться в меню:"
+)
+
+
+def tg_len(text: str) -> int:
+    """Длина строки так, как её считает Telegram (в UTF-16 code units)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_text(text: str, limit: int) -> tuple[str, str]:
+    """
+    Делим текст на голову (не длиннее limit) и хвост.
+    Режем по абзацу, затем по строке, затем по пробелу — чтобы не рвать упражнение посередине.
+    """
+    if tg_len(text) <= limit:
+        return text, ""
+
+    # максимальный префикс, который влезает в лимит
+    units = 0
+    cut = 0
+    for i, ch in enumerate(text):
+        units += 2 if ord(ch) > 0xFFFF else 1
+        if units > limit:
+            cut = i
+            break
+
+    for sep in ("\n\n", "\n", " "):
+        pos = text.rfind(sep, 0, cut)
+        if pos > 0:
+            cut = pos
+            break
+
+    return text[:cut].rstrip(), text[cut:].lstrip()
+
+
+def split_text_chunks(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list[str]:
+    """Разбить текст на куски, каждый из которых влезает в одно сообщение."""
+    chunks = []
+    while text:
+        head, text = split_text(text, limit)
+        chunks.append(head)
+    return chunks
+
+
+def build_training_plan(place: str, month: str, training_num: str) -> dict:
+    """
+    План отправки тренировки:
+    - videos  — file_id для медиагруппы,
+    - caption — подпись к медиагруппе (начало текста тренировки),
+    - texts   — остаток текста, который не влез в подпись.
+    """
+    videos = CATALOG.videos(place, month, training_num)
+    videos = [v for v in videos if v]  # фильтрация пустых
+
+    training_text = TRAINING_TEXTS.get(place, {}).get(month, {}).get(training_num)
+    if not training_text:
+        training_text = f"Описание тренировки {training_num} ({month}): скоро добавим 💪"
+
+    if not videos:
+        return {
+            "videos": [],
+            "caption": None,
+            "texts": split_text_chunks("Видео для этой тренировки пока не привязаны.\n\n" + training_text),
+        }
+
+    caption, rest = split_text(training_text, MessageLimit.CAPTION_LENGTH)
+    return {
+        "videos": videos,
+        "caption": caption,
+        "texts": split_text_chunks(rest),
+    }
+
+
+def chunk_balanced(items: list, limit: int = MediaGroupLimit.MAX_MEDIA_LENGTH) -> list[list]:
+    """
+    Делим на минимальное число групп не больше limit и выравниваем их по размеру:
+    11 → 6 + 5, 21 → 7 + 7 + 7 (а не 10 + 10 + 1 — медиагруппа из одного элемента невозможна).
+    """
+    if not items:
+        return []
+    count = -(-len(items) // limit)
+    size, extra = divmod(len(items), count)
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def training_media(plan: dict) -> list[list[InputMediaVideo]]:
+    """Медиагруппы тренировки (Telegram берёт не больше 10 видео в группу); подпись — у первого видео."""
+    media = [
+        InputMediaVideo(media=vid, caption=plan["caption"] if i == 0 else None)
+        for i, vid in enumerate(plan["videos"])
+    ]
+    return chunk_balanced(media)
+
+
+async def send_media_chunk(bot, chat_id: int, chunk: list[InputMediaVideo], **kwargs) -> list:
+    """Одна группа из training_media; одно видео — обычным sendVideo (группа из одного не отправится)."""
+    if len(chunk) == 1:
+        item = chunk[0]
+        return [await bot.send_video(chat_id=chat_id, video=item.media, caption=item.caption, **kwargs)]
+    return list(await bot.send_media_group(chat_id=chat_id, media=chunk, **kwargs))
+
+
+# ====== ЗАДЕРЖКИ ПО ЭТАПАМ ОТПРАВКИ ======
+class StageLatency:
+    """Скользящее окно длительностей по этапам (в секундах), чтобы показать p50/p95 в /stats."""
+
+    def __init__(self, window: int = 500):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+
+    def observe(self, stage: str, seconds: float):
+        self._samples[stage].append(seconds)
+
+    @contextmanager
+    def measure(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def summary(self) -> dict:
+        """stage -> (count, p50, p95)"""
+        result = {}
+        for stage, samples in self._samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            p50 = ordered[int(0.50 * (len(ordered) - 1))]
+            p95 = ordered[int(0.95 * (len(ordered) - 1))]
+            result[stage] = (len(ordered), p50, p95)
+        return result
+
+
+SEND_TRAINING_LATENCY = StageLatency()
+
+
+async def track_training_open(user_id: int, username: str | None):
+    """Аналитика открытия тренировки — идёт параллельно с отправкой видео и не задерживает её."""
+    with SEND_TRAINING_LATENCY.measure("analytics"):
+        try:
+            await track_user_event(user_id, username, opened_training=True)
+        except Exception as e:
+            # статистика не должна ломать выдачу тренировки
+            logs.swallowed("track_training_open", e)
+
+
 # ====== ТРЕНИРОВКА + ОГРАНИЧЕНИЕ 1 В ДЕНЬ (кроме админа) ======
 async def send_training(update: Update, context: ContextTypes.DEFAULT_TYPE, place: str, month: str, training_num: str):
+    """
+    Отправка тренировки конвейером:
+    - запись аналитики идёт параллельно со всем остальным,
+    - порядок соблюдается только там, где его видит пользователь: видео → текст → подвал.
+    Длительность каждого этапа пишется в SEND_TRAINING_LATENCY.
+    """
+    started = time.perf_counter()
     chat_id = update.effective_chat.id
     user = update.effective_user
     user_id = user.id
 
-    # считаем открытие тренировки
-    track_user_event(user_id, user.username, opened_training=True)
-
-    # 👉 Админ (из DEV_USER_IDS) тренируется без ограничения
-    if user_id not in DEV_USER_IDS and month != "trial":
-        # 1 тренировка в день
-        today = datetime.now(timezone.utc).date().isoformat()
-        last_view_date = context.user_data.get("last_training_date")
-
-        if last_view_date == today:
+    # считаем открытие тренировки в фоне. Не TaskGroup: ошибка отправки должна дойти до PTB
+    # как есть (Forbidden, RetryAfter), а не завёрнутой в ExceptionGroup
+    analytics = asyncio.create_task(track_training_open(user_id, user.username))
+    try:
+        with SEND_TRAINING_LATENCY.measure("limit"):
+            limit_reached = False
+            # 👉 Админ (из DEV_USER_IDS) тренируется без ограничения
+            if user_id not in DEV_USER_IDS and month != "trial":
+                # 1 тренировка в день
+                today = datetime.now(timezone.utc).date().isoformat()
+                limit_reached = context.user_data.get("last_training_date") == today
+                if not limit_reached:
+                    # сохраняем дату просмотра сразу, чтобы двойной тап не отдал вторую тренировку
+                    context.user_data["last_training_date"] = today
+
+        if limit_reached:
             await context.bot.send_message(
                 chat_id,
                 "Вы уже смотрели тренировку сегодня ✅\n"
@@ -1249,119 +2452,525 @@ async def send_training(update: Update, context: ContextTypes.DEFAULT_TYPE, plac
             )
             return
 
-        # сохраняем дату просмотра
-        context.user_data["last_training_date"] = today
+        messages_to_delete = await deliver_training(context, chat_id, place, month, training_num, started)
+    finally:
+        # track_training_open ошибки не пробрасывает
+        await analytics
+
+    # удаление через 24 часа — одной задачей и одним запросом deleteMessages
+    if context.job_queue and messages_to_delete:
+        context.job_queue.run_once(
+            delete_message_job,
+            when=TRAINING_TTL_SECONDS,
+            data={"chat_id": chat_id, "message_ids": messages_to_delete},
+        )
+
+    SEND_TRAINING_LATENCY.observe("total", time.perf_counter() - started)
 
-    # ===== дальше идёт твоя логика отправки видео/текста/документа =====
 
+async def deliver_training(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    place: str,
+    month: str,
+    training_num: str,
+    started: float,
+) -> list[int]:
+    """Видео → остаток текста → подвал. Возвращает message_id для удаления."""
     # соберём все message_id, чтобы удалить
     messages_to_delete = []
 
-    # видео
-    videos = VIDEO_IDS.get(place, {}).get(month, {}).get(training_num, [])
-    videos = [v for v in videos if v]  # фильтрация пустых
-
-    if videos:
-        media = [InputMediaVideo(media=vid) for vid in videos]
-        try:
-            msgs = await context.bot.send_media_group(chat_id=chat_id, media=media, protect_content=True)
-            for m in msgs:
-                messages_to_delete.append(m.message_id)
-        except BadRequest as e:
-            await context.bot.send_message(
-                chat_id,
-                "Не удалось отправить все видео сразу (возможно, битый file_id). Пробую по одному.",
-                protect_content=True,
-            )
-            for vid in videos:
+    plan = build_training_plan(place, month, training_num)
+    texts = plan["texts"]
+
+    # тренировка уже выложена в канал-хранилище — вся (видео + текст) одним copyMessages
+    copied = None
+    if VAULT_CHAT_ID:
+        with SEND_TRAINING_LATENCY.measure("vault"):
+            copied = await copy_from_vault(context.bot, chat_id, (place, month, training_num), plan)
+    if copied is not None:
+        messages_to_delete.extend(copied)
+        SEND_TRAINING_LATENCY.observe("first_video", time.perf_counter() - started)
+        texts = []
+
+    # видео + начало текста тренировки подписью к медиагруппе
+    elif plan["videos"]:
+        chunks = training_media(plan)
+        with SEND_TRAINING_LATENCY.measure("media"):
+            # группы строго по очереди: иначе Telegram может показать их не в том порядке
+            for i, chunk in enumerate(chunks):
                 try:
-                    m = await context.bot.send_video(chat_id=chat_id, video=vid, protect_content=True)
-                    messages_to_delete.append(m.message_id)
-                except BadRequest as single_err:
+                    msgs = await send_media_chunk(context.bot, chat_id, chunk, protect_content=True)
+                except BadRequest as e:
                     await context.bot.send_message(
-                        ADMIN_CHAT_ID,
-                        f"send_video failed for user {chat_id}, place={place}, month={month}, training={training_num}, file_id={vid}. Error: {single_err}",
+                        chat_id,
+                        "Не удалось отправить все видео сразу (возможно, битый file_id). Пробую по одному.",
+                        protect_content=True,
                     )
-    else:
-        m = await context.bot.send_message(
+                    for vid in [item.media for rest in chunks[i:] for item in rest]:
+                        try:
+                            m = await context.bot.send_video(chat_id=chat_id, video=vid, protect_content=True)
+                            messages_to_delete.append(m.message_id)
+                        except BadRequest as single_err:
+                            await context.bot.send_message(
+                                ADMIN_CHAT_ID,
+                                f"send_video failed for user {chat_id}, place={place}, month={month}, training={training_num}, file_id={vid}. Error: {single_err}",
+                            )
+                    if i == 0:
+                        # подпись не доехала вместе с медиагруппой — отправляем её текстом
+                        texts = [plan["caption"]] + texts
+                        SEND_TRAINING_LATENCY.observe("first_video", time.perf_counter() - started)
+                    break
+                messages_to_delete.extend(m.message_id for m in msgs)
+                if i == 0:
+                    # то, что реально чувствует пользователь
+                    SEND_TRAINING_LATENCY.observe("first_video", time.perf_counter() - started)
+
+    with SEND_TRAINING_LATENCY.measure("text"):
+        # остаток текста тренировки
+        for chunk in texts:
+            txt_msg = await context.bot.send_message(chat_id, chunk, protect_content=True)
+            messages_to_delete.append(txt_msg.message_id)
+
+        # предупреждение + кнопка назад одним сообщением
+        footer_msg = await context.bot.send_message(
             chat_id,
-            "Видео для этой тренировки пока не привязаны.",
+            TRAINING_FOOTER_TEXT,
+            parse_mode="HTML",
+            reply_markup=ReplyKeyboardMarkup([["Вернуться в меню"]], resize_keyboard=True),
             protect_content=True,
         )
-        messages_to_delete.append(m.message_id)
+        messages_to_delete.append(footer_msg.message_id)
 
-    # предупреждение
-    warn_msg = await context.bot.send_message(
-        chat_id,
-        "<b><i>Тренировка автоматически удалится через 24 часа</i></b>",
-        parse_mode="HTML",
-        protect_content=True,
-    )
-    messages_to_delete.append(warn_msg.message_id)
+    return messages_to_delete
 
-    # текст тренировки
-    training_text = TRAINING_TEXTS.get(place, {}).get(month, {}).get(training_num)
-    if training_text:
-        txt_msg = await context.bot.send_message(chat_id, training_text, protect_content=True)
-    else:
-        txt_msg = await context.bot.send_message(
-            chat_id,
-            f"Описание тренировки {training_num} ({month}): скоро добавим 💪",
-            protect_content=True,
+
+async def delete_message_job(context: ContextTypes.DEFAULT_TYPE):
+    data = context.job.data
+    try:
+        await context.bot.delete_messages(chat_id=data["chat_id"], message_ids=data["message_ids"])
+    except Exception as e:
+        # сообщения могли удалить руками или чат заблокирован — это не повод ронять джобу
+        logs.swallowed("delete_message_job", e)
+
+
+# ====== КАНАЛ-ХРАНИЛИЩЕ ТРЕНИРОВОК ======
+# Тренировка заранее выкладывается в приватный канал (видео + текст), а пользователю уходит
+# одним copyMessages (до 100 сообщений за вызов, protect_content сохраняется) вместо
+# sendMediaGroup + нескольких sendMessage. Битое видео чинится одной перевыкладкой (/vault post).
+# Бот должен быть админом канала. VAULT_CHAT_ID не задан — всё отправляется как раньше.
+VAULT_CHAT_ID = int(os.getenv("VAULT_CHAT_ID", "0"))
+VAULT_COPY_LIMIT = 100
+VAULT_POST_MAX_ATTEMPTS = 5
+# в один канал Telegram пускает около 20 сообщений в минуту
+VAULT_POST_PAUSE_SECONDS = 3
+
+VAULT_INDEX: dict[tuple[str, str, str], tuple[str, list[int]]] = {}
+_vault_post_lock = asyncio.Lock()
+
+
+def training_fingerprint(plan: dict) -> str:
+    """Отпечаток плана: поменялись видео или текст — выложенная копия в канале устарела."""
+    payload = json.dumps([plan["videos"], plan["caption"], plan["texts"]], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+async def reload_vault_index():
+    global VAULT_INDEX
+    if VAULT_CHAT_ID:
+        VAULT_INDEX = await STORAGE.vault.index()
+
+
+async def forget_vault_slot(slot: tuple[str, str, str]):
+    VAULT_INDEX.pop(slot, None)
+    await STORAGE.vault.delete(*slot)
+
+
+async def copy_from_vault(bot, chat_id: int, slot: tuple[str, str, str], plan: dict) -> list[int] | None:
+    """message_id скопированных сообщений или None — в канале нет актуальной копии, шлём как обычно."""
+    if not VAULT_CHAT_ID:
+        return None
+    entry = VAULT_INDEX.get(slot)
+    if entry is None or entry[0] != training_fingerprint(plan) or len(entry[1]) > VAULT_COPY_LIMIT:
+        return None
+
+    vault_ids = entry[1]
+    try:
+        copied = await bot.copy_messages(
+            chat_id=chat_id, from_chat_id=VAULT_CHAT_ID, message_ids=vault_ids, protect_content=True
         )
-    messages_to_delete.append(txt_msg.message_id)
+    except BadRequest as e:
+        if "chat not found" in str(e).lower():
+            raise  # беда с чатом пользователя, а не с каналом
+        logs.swallowed("copy_from_vault", e, log)
+        copied = []
 
+    if len(copied) == len(vault_ids):
+        return [m.message_id for m in copied]
 
-    # кнопка назад
-    await context.bot.send_message(
-        chat_id,
-        "Можешь вернуться в меню:",
-        reply_markup=ReplyKeyboardMarkup([["Вернуться в меню"]], resize_keyboard=True),
-        protect_content=True,
+    # часть сообщений в канале удалили — неполную тренировку убираем и шлём заново обычным способом
+    if copied:
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=[m.message_id for m in copied])
+        except Exception as e:
+            logs.swallowed("copy_from_vault.cleanup", e, log)
+    await forget_vault_slot(slot)
+    await bot.send_message(
+        ADMIN_CHAT_ID,
+        f"⚠️ Хранилище: тренировка {slot_label(*slot)} в канале неполная, отправляю без неё. "
+        f"Перевыложить: /vault post {' '.join(slot)}",
     )
+    return None
 
-    # удаление через 24 часа
-    if context.job_queue:
-        for mid in messages_to_delete:
-            context.job_queue.run_once(
-                delete_message_job,
-                when=86400,  # 24 часа
-                data={"chat_id": chat_id, "message_id": mid},
-            )
+
+async def vault_call(send):
+    """send() — корутина отправки в канал; на RetryAfter ждём и повторяем."""
+    for attempt in range(VAULT_POST_MAX_ATTEMPTS):
+        try:
+            return await send()
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            if attempt == VAULT_POST_MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(retry_after)
+
+
+async def post_training_to_vault(bot, place: str, month: str, training: str) -> list[int]:
+    """Выложить тренировку в канал (видео + текст, без подвала с клавиатурой) и записать в индекс."""
+    plan = build_training_plan(place, month, training)
+    message_ids = []
+    for chunk in training_media(plan):
+        if message_ids:
+            await asyncio.sleep(VAULT_POST_PAUSE_SECONDS)
+        msgs = await vault_call(lambda: send_media_chunk(bot, VAULT_CHAT_ID, chunk))
+        message_ids.extend(m.message_id for m in msgs)
+    for chunk in plan["texts"]:
+        if message_ids:
+            await asyncio.sleep(VAULT_POST_PAUSE_SECONDS)
+        msg = await vault_call(lambda: bot.send_message(VAULT_CHAT_ID, chunk))
+        message_ids.append(msg.message_id)
+
+    slot = (place, month, training)
+    old = VAULT_INDEX.get(slot)
+    await STORAGE.vault.save(place, month, training, training_fingerprint(plan), message_ids)
+    VAULT_INDEX[slot] = (training_fingerprint(plan), message_ids)
+    if old:
+        try:
+            await bot.delete_messages(chat_id=VAULT_CHAT_ID, message_ids=old[1])
+        except Exception as e:
+            # старые копии в канале никому не мешают — индекс на них уже не указывает
+            logs.swallowed("post_training_to_vault.cleanup", e, log)
+    return message_ids
+
+
+async def run_vault_post(bot, admin_chat_id: int, slots: list[tuple[str, str, str]], force: bool):
+    async with _vault_post_lock:
+        posted, skipped, failed = 0, 0, []
+        for slot in slots:
+            entry = VAULT_INDEX.get(slot)
+            if not force and entry is not None and entry[0] == training_fingerprint(build_training_plan(*slot)):
+                skipped += 1
+                continue
+            try:
+                await post_training_to_vault(bot, *slot)
+                posted += 1
+            except Exception as e:
+                log.exception("vault post failed", extra={"slot": slot_label(*slot)})
+                failed.append(f"{slot_label(*slot)}: {e}")
+            await asyncio.sleep(VAULT_POST_PAUSE_SECONDS)
+
+    lines = [f"Хранилище обновлено ✅ выложено: {posted}, уже актуальны: {skipped}, ошибок: {len(failed)}"]
+    lines.extend(failed[:10])
+    await bot.send_message(admin_chat_id, "\n".join(lines))
+
+
+VAULT_USAGE = (
+    "Использование:\n"
+    "/vault — сколько тренировок выложено в канал и сколько устарело\n"
+    "/vault post [force] [place [month [training]]] — выложить новые/изменённые тренировки "
+    "(force — перевыложить даже актуальные, например если в канале битое видео)\n"
+    "Пример: /vault post force gym 2-3 Ноги"
+)
 
 
-async def delete_message_job(context: ContextTypes.DEFAULT_TYPE):
-    data = context.job.data
-    try:
-        await context.bot.delete_message(chat_id=data["chat_id"], message_id=data["message_id"])
-    except Exception:
-        pass
+async def cmd_vault(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if update.effective_user.id not in DEV_USER_IDS:
+        await message.reply_text("Эта команда только для администратора бота.")
+        return
+    if not VAULT_CHAT_ID:
+        await message.reply_text("Канал-хранилище не настроен: задай VAULT_CHAT_ID.")
+        return
+
+    args = list(context.args)
+    if not args:
+        fresh = stale = missing = 0
+        for slot in CATALOG.slots():
+            entry = VAULT_INDEX.get(slot)
+            if entry is None:
+                missing += 1
+            elif entry[0] == training_fingerprint(build_training_plan(*slot)):
+                fresh += 1
+            else:
+                stale += 1
+        await message.reply_text(
+            f"Хранилище {VAULT_CHAT_ID}:\n"
+            f"• актуальных тренировок: {fresh}\n"
+            f"• устарели (поменялись видео или текст): {stale}\n"
+            f"• не выложены: {missing}\n\n" + VAULT_USAGE
+        )
+        return
+
+    if args[0].lower() != "post":
+        await message.reply_text(VAULT_USAGE)
+        return
+    args = args[1:]
+    force = bool(args) and args[0].lower() == "force"
+    if force:
+        args = args[1:]
+
+    place = args[0].lower() if args else None
+    month = args[1] if len(args) > 1 else None
+    training = " ".join(args[2:]) if len(args) > 2 else None
+    slots = [
+        slot
+        for slot in CATALOG.slots()
+        if (place is None or slot[0] == place)
+        and (month is None or slot[1] == month)
+        and (training is None or slot[2].lower() == training.lower())
+    ]
+    if not slots:
+        await message.reply_text("Нет таких тренировок.\n\n" + VAULT_USAGE)
+        return
+    if _vault_post_lock.locked():
+        await message.reply_text("Выкладка в хранилище уже идёт — дождись отчёта.")
+        return
+
+    await message.reply_text(f"Выкладываю в хранилище, тренировок к проверке: {len(slots)}. Пришлю отчёт.")
+    context.application.create_task(
+        run_vault_post(context.bot, update.effective_chat.id, slots, force), update=update
+    )
 
 
 # ловим медиа, чтобы получать file_id
 async def catch_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    session = context.user_data.get("ingest")
+    if session and update.effective_user.id in DEV_USER_IDS:
+        await ingest_video(update, context, session)
+        return
+
     if update.message.video:
         fid = update.message.video.file_id
-        print("VIDEO file_id:", fid)
+        log.info("video received", extra={"file_id": fid, "user_id": update.effective_user.id})
         await update.message.reply_text("Видео получил ✅. Смотри file_id в консоли.", protect_content=True)
     elif update.message.document:
         fid = update.message.document.file_id
-        print("DOCUMENT file_id:", fid)
+        log.info("document received", extra={"file_id": fid, "user_id": update.effective_user.id})
         await update.message.reply_text("Документ получил ✅. Смотри file_id в консоли.", protect_content=True)
     else:
         await update.message.reply_text("Пришли видео или документ — я дам тебе file_id.", protect_content=True)
 
 
-def main():
-    import sys, asyncio
+# ====== НАСТРОЙКИ HTTP-КЛИЕНТА PTB ======
+# Исходящие запросы (sendMessage / sendMediaGroup / ...) и getUpdates ходят через разные пулы,
+# чтобы пачка отправок видео не забирала соединение у long polling.
+BOT_HTTP_POOL_SIZE = int(os.getenv("BOT_HTTP_POOL_SIZE", "64"))
+BOT_HTTP_VERSION = os.getenv("BOT_HTTP_VERSION", "1.1")  # "2" — HTTP/2, нужен пакет h2
+BOT_HTTP_CONNECT_TIMEOUT = float(os.getenv("BOT_HTTP_CONNECT_TIMEOUT", "5"))
+BOT_HTTP_READ_TIMEOUT = float(os.getenv("BOT_HTTP_READ_TIMEOUT", "10"))
+BOT_HTTP_WRITE_TIMEOUT = float(os.getenv("BOT_HTTP_WRITE_TIMEOUT", "10"))
+BOT_HTTP_MEDIA_WRITE_TIMEOUT = float(os.getenv("BOT_HTTP_MEDIA_WRITE_TIMEOUT", "60"))
+BOT_HTTP_POOL_TIMEOUT = float(os.getenv("BOT_HTTP_POOL_TIMEOUT", "5"))
+# адрес Bot API: свой Local Bot API Server или фейковый сервер из bench/
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+TELEGRAM_API_BASE_URL = f"{TELEGRAM_API_URL}/bot"
+TELEGRAM_API_FILE_URL = f"{TELEGRAM_API_URL}/file/bot"
 
-    if sys.platform.startswith("win"):
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-    # инициализируем БД
-    init_db()
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, который пишет длительность каждого вызова Bot API в метрики."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            metrics.observe_api_call(url.rsplit("/", 1)[-1], time.perf_counter() - started)
+
+
+def build_send_request() -> HTTPXRequest:
+    """Пул для всех исходящих вызовов Bot API."""
+    return InstrumentedHTTPXRequest(
+        connection_pool_size=BOT_HTTP_POOL_SIZE,
+        http_version=BOT_HTTP_VERSION,
+        connect_timeout=BOT_HTTP_CONNECT_TIMEOUT,
+        read_timeout=BOT_HTTP_READ_TIMEOUT,
+        write_timeout=BOT_HTTP_WRITE_TIMEOUT,
+        media_write_timeout=BOT_HTTP_MEDIA_WRITE_TIMEOUT,
+        pool_timeout=BOT_HTTP_POOL_TIMEOUT,
+    )
+
+
+def build_updates_request() -> HTTPXRequest:
+    """
+    Отдельный маленький пул только под getUpdates.
+    read_timeout здесь — запас сверх таймаута long polling (PTB прибавляет его сам).
+    """
+    return HTTPXRequest(
+        connection_pool_size=2,
+        http_version=BOT_HTTP_VERSION,
+        connect_timeout=BOT_HTTP_CONNECT_TIMEOUT,
+        read_timeout=BOT_HTTP_READ_TIMEOUT,
+        write_timeout=BOT_HTTP_WRITE_TIMEOUT,
+        pool_timeout=BOT_HTTP_POOL_TIMEOUT,
+    )
+
+
+# ====== ДИСПЕТЧЕР АПДЕЙТОВ ======
+# платежи — в отдельной полосе со своим лимитом, остальное — параллельно, но по порядку внутри пользователя
+UPDATES_FAST_LANE_CONCURRENCY = int(os.getenv("UPDATES_FAST_LANE_CONCURRENCY", "8"))
+UPDATES_DEFAULT_LANE_CONCURRENCY = int(os.getenv("UPDATES_DEFAULT_LANE_CONCURRENCY", "32"))
+
+
+# ====== СТОРОЖ EVENT LOOP ======
+# heartbeat раз в LOOP_LAG_INTERVAL; стек снимаем при зависании дольше LOOP_SLOW_CALLBACK_SECONDS,
+# админу пишем, если лаг больше LOOP_LAG_SLO_SECONDS (не чаще раза в LOOP_LAG_ALERT_EVERY_SECONDS)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_SLOW_CALLBACK_SECONDS = float(os.getenv("LOOP_SLOW_CALLBACK_SECONDS", "0.25"))
+LOOP_LAG_SLO_SECONDS = float(os.getenv("LOOP_LAG_SLO_SECONDS", "1"))
+LOOP_LAG_ALERT_EVERY_SECONDS = float(os.getenv("LOOP_LAG_ALERT_EVERY_SECONDS", "600"))
+
+LOOP_MONITOR = LoopMonitor(
+    interval=LOOP_LAG_INTERVAL,
+    slow_threshold=LOOP_SLOW_CALLBACK_SECONDS,
+    slo=LOOP_LAG_SLO_SECONDS,
+    alert_every=LOOP_LAG_ALERT_EVERY_SECONDS,
+    handler_file=__file__,
+)
+
+
+# ====== МЕТРИКИ ======
+# /metrics в формате Prometheus; у шарда N порт METRICS_PORT + N. METRICS_PORT=0 — не поднимать.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+_metrics_runner = None
+
+
+async def start_metrics_server():
+    global _metrics_runner
+    if not METRICS_PORT or _metrics_runner is not None:
+        return
+    port = METRICS_PORT + SHARD_ID
+    try:
+        _metrics_runner = await metrics.start_server(METRICS_HOST, port)
+    except OSError as e:
+        # метрики не должны мешать боту стартовать
+        log.warning("metrics server not started on %s:%s: %s", METRICS_HOST, port, e)
+
+
+async def stop_metrics_server():
+    global _metrics_runner
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+
+
+async def post_init(application: Application):
+    global _subscription_changes_seen
+
+    await BOT_API.start(application.bot.base_url)
+    await start_metrics_server()
+
+    async def send_loop_alert(text: str):
+        if SHARD_COUNT > 1:
+            text = f"[шард {SHARD_ID}] {text}"
+        await application.bot.send_message(ADMIN_CHAT_ID, text)
+
+    LOOP_MONITOR.start(on_alert=send_loop_alert)
+
+    # сначала запоминаем позицию в журнале, потом грузим кеш — так ни одно изменение не потеряется
+    await init_db()
+
+    _subscription_changes_seen = await STORAGE.subscriptions.last_change_id()
+    ACTIVE_SUBS.load(await STORAGE.subscriptions.active(today_epoch_day()))
+    CATALOG.load(*await STORAGE.catalog.latest())
+    await reload_vault_index()
+    await prewarm_invoice_links(application.bot)
+
+    # у воркеров-шардов сигналы обрабатывает ingress-процесс
+    if application.updater is not None:
+        install_stop_signals(application)
+
+    if SHARD_ID == 0:
+        await report_restart(application)
+
+    # у воркеров-шардов аренду держит ingress-процесс
+    if application.updater is not None:
+        await acquire_polling_lease(application)
+    # после аренды: старый инстанс сохраняет свои таймеры удаления до того, как её отдать
+    await restore_pending_deletes(application)
 
-    app = Application.builder().token(TOKEN).build()
+    if application.job_queue:
+        if SHARD_COUNT > 1:
+            application.job_queue.run_repeating(
+                sync_subscription_changes_job, interval=SUBSCRIPTION_CHANGES_SYNC_SECONDS
+            )
+            application.job_queue.run_repeating(sync_catalog_job, interval=CATALOG_SYNC_SECONDS)
+
+        # фоновые задачи на всю базу — только в одном процессе
+        if SHARD_ID == 0:
+            application.job_queue.run_once(resume_broadcasts_job, when=1)
+            application.job_queue.run_daily(expiry_sweeper_job, time=EXPIRY_SWEEP_TIME_UTC)
+            application.job_queue.run_daily(reconcile_stars_job, time=RECONCILE_TIME_UTC)
+            application.job_queue.run_repeating(prune_subscription_changes_job, interval=600)
+            application.job_queue.run_repeating(sweep_pending_deletes_job, interval=PENDING_DELETES_SWEEP_SECONDS)
+
+
+async def post_shutdown(application: Application):
+    await LOOP_MONITOR.stop()
+    await BOT_API.close()
+    await release_polling_lease()
+    await close_db()
+    await stop_metrics_server()
+
+
+def instrument_handlers(app: Application):
+    """
+    Оборачиваем колбэки всех зарегистрированных хендлеров в метрики (латентность, ошибки, in-flight)
+    и в логи (correlation_id апдейта).
+    """
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = metrics.instrument(logs.with_correlation(handler.callback, LOG_UPDATE_SAMPLE))
+
+
+def build_application(with_updater: bool = True) -> Application:
+    """
+    Собираем Application со всеми хендлерами.
+    with_updater=False — для воркера-шарда: апдейты приходят не из getUpdates, а от ingress-процесса.
+    """
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        .base_file_url(TELEGRAM_API_FILE_URL)
+        .request(build_send_request())
+        .concurrent_updates(
+            LaneUpdateProcessor(
+                fast_concurrency=UPDATES_FAST_LANE_CONCURRENCY,
+                default_concurrency=UPDATES_DEFAULT_LANE_CONCURRENCY,
+            )
+        )
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if with_updater:
+        builder = builder.get_updates_request(build_updates_request())
+    else:
+        builder = builder.updater(None)
+    app = builder.build()
 
     # Команды
     app.add_handler(CommandHandler("start", start))
@@ -1370,22 +2979,61 @@ def main():
     app.add_handler(CommandHandler("devsub", cmd_devsub))
     app.add_handler(CommandHandler("subs", cmd_subs))
     app.add_handler(CommandHandler("refund", cmd_refund))
+    app.add_handler(CommandHandler("reconcile", cmd_reconcile))
     app.add_handler(CommandHandler("grant", cmd_grant))     
     app.add_handler(CommandHandler("revoke", cmd_revoke)) 
+    app.add_handler(CommandHandler("bulk", cmd_bulk))
+    app.add_handler(CommandHandler("ingest", cmd_ingest))
+    app.add_handler(CommandHandler("publish", cmd_publish))
+    app.add_handler(CommandHandler("vault", cmd_vault))
     app.add_handler(CommandHandler("restart", cmd_restart))
+    app.add_handler(CommandHandler("profile", cmd_profile))
     app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("broadcast", cmd_broadcast))
 
 
     # Payments
     app.add_handler(PreCheckoutQueryHandler(precheckout_handler))
+    app.add_handler(CallbackQueryHandler(renew_callback, pattern=r"^renew:(month|year)$"))
     app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
 
     # Остальное
+    # CSV для /bulk: команда в подписи к файлу (раньше catch_media, который ловит все документы)
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/bulk(@\w+)?(\s|$)"), cmd_bulk))
     app.add_handler(MessageHandler(filters.VIDEO | filters.Document.ALL, catch_media))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
 
-    print("Bot started...")
-    app.run_polling()
+    instrument_handlers(app)
+    return app
+
+
+def main():
+    if sys.platform.startswith("win"):
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    logs.setup(LOG_LEVEL)
+    log.info(
+        "starting",
+        extra={"storage": STORAGE_BACKEND, "db_path": str(DB_PATH.resolve()), "shards": SHARD_COUNT},
+    )
+
+    if SHARD_COUNT > 1:
+        from sharding import run_sharded
+
+        # схему БД приводим один раз, до старта воркеров
+        asyncio.run(migrate_db())
+        if run_sharded(SHARD_COUNT):
+            sys.exit(RESTART_EXIT_CODE)
+        return
+
+    app = build_application()
+
+    log.info("bot started")
+    # SIGINT/SIGTERM ставит post_init (install_stop_signals) — с дренажом апдейтов
+    app.run_polling(stop_signals=None)
+
+    if RESTART_REQUESTED:
+        sys.exit(RESTART_EXIT_CODE)
 
 
 if __name__ == "__main__":
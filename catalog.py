@@ -0,0 +1,77 @@
+"""
+Каталог видео тренировок: content_data.VIDEO_IDS + правки, опубликованные админом прямо из бота.
+
+Загрузка новых видео (режим /ingest в bot.py):
+1. админ выбирает слот — место / месяц / тренировка — и присылает видео пачкой;
+2. каждое видео ложится в черновик (catalog_uploads) в порядке прихода; повтор того же файла
+   (по file_unique_id — он одинаковый у одного видео, даже если file_id разные) отклоняется;
+3. /publish одной транзакцией собирает из черновика новую версию каталога и очищает черновик —
+   пользователи видят либо старый каталог целиком, либо новый целиком.
+
+Опубликованная версия — overlay в той же форме, что VIDEO_IDS: {place: {month: {training: [file_id]}}}.
+Слот, которого нет в overlay, берётся из content_data.py как раньше, поэтому без публикаций
+ничего не меняется. Добавлять можно только в слоты, которые есть в VIDEO_IDS: до остальных
+не дойти из меню.
+
+Видео из content_data.py для дедупликации не видны: для них известен только file_id.
+"""
+import logging
+
+log = logging.getLogger("bot.catalog")
+
+
+def slot_label(place: str, month: str, training: str) -> str:
+    return f"{place} / {month} / {training}"
+
+
+class Catalog:
+    def __init__(self, base: dict):
+        self.base = base
+        self.version = 0
+        self._overlay: dict = {}
+
+    def load(self, version: int, overlay: dict):
+        # подменяем ссылку целиком: читатели видят либо старую версию, либо новую
+        self._overlay = overlay
+        self.version = version
+        log.info("catalog loaded", extra={"version": version})
+
+    def has_slot(self, place: str, month: str, training: str) -> bool:
+        return training in self.base.get(place, {}).get(month, {})
+
+    def slots(self):
+        """Все тренировки из меню: (place, month, training)."""
+        for place, months in self.base.items():
+            for month, trainings in months.items():
+                for training in trainings:
+                    yield place, month, training
+
+    def videos(self, place: str, month: str, training: str) -> list[str]:
+        slot = self._overlay.get(place, {}).get(month, {}).get(training)
+        if slot is not None:
+            return slot
+        return self.base.get(place, {}).get(month, {}).get(training, [])
+
+
+def merge_uploads(base: dict, overlay: dict, uploads: list[tuple]) -> dict:
+    """
+    Новый overlay: uploads (place, month, training, file_id, replace) в порядке загрузки дописываются
+    в конец слота; если хоть одна загрузка слота с replace — слот собирается заново только из загруженного.
+    """
+    merged = {place: {month: dict(trainings) for month, trainings in months.items()} for place, months in overlay.items()}
+    replaced = {(place, month, training) for place, month, training, _, replace in uploads if replace}
+    touched = set()
+    for place, month, training, file_id, _ in uploads:
+        slot = (place, month, training)
+        trainings = merged.setdefault(place, {}).setdefault(month, {})
+        if slot not in touched:
+            touched.add(slot)
+            if slot in replaced:
+                trainings[training] = []
+            else:
+                current = trainings.get(training)
+                if current is None:
+                    current = base.get(place, {}).get(month, {}).get(training, [])
+                trainings[training] = [video for video in current if video]
+        trainings[training].append(file_id)
+    return merged
@@ -0,0 +1,100 @@
+"""
+Передача поллинга между инстансами бота без окна простоя (деплой, рестарт контейнера).
+
+getUpdates одновременно может держать только один процесс (второй получит 409 Conflict),
+поэтому право поллить — аренда в общей БД (таблица leases, см. storage.py):
+
+1. новый инстанс стартует, прогревает кеши и только потом вызывает acquire(): если аренда
+   занята, он просит владельца её отдать (handover_to) и ждёт;
+2. старый инстанс на очередном heartbeat видит просьбу, перестаёт забирать апдейты
+   и сразу отпускает аренду — уже полученные апдейты дорабатывает сам;
+3. новый забирает аренду и начинает поллинг с того offset, который подтвердил старый.
+
+Если старый упал и не отпустил аренду — она истечёт через ttl.
+
+Локально: два процесса с общей базой
+    BOT_DB_PATH=/tmp/corpus.db python bot.py     # старый
+    BOT_DB_PATH=/tmp/corpus.db python bot.py     # новый — первый передаст ему поллинг и выйдет
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+
+import logs
+
+log = logging.getLogger("bot.handover")
+
+
+def instance_id() -> str:
+    """Уникальный id процесса: в контейнерах pid часто 1, поэтому добавляем хост и случайный хвост."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class PollingLease:
+    def __init__(self, repo, name: str, holder: str, ttl: float = 15, heartbeat: float = 3, retry: float = 0.2):
+        self.repo = repo
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self.held = False
+        self._task: asyncio.Task | None = None
+
+    async def acquire(self) -> float:
+        """Ждём аренду (попросив текущего владельца её отдать). Возвращает, сколько ждали."""
+        started = time.perf_counter()
+        requested = False
+        while not await self.repo.try_acquire(self.name, self.holder, self.ttl):
+            if not requested:
+                await self.repo.request_handover(self.name, self.holder)
+                requested = True
+                log.info("lease is held by another instance, handover requested", extra={"lease": self.name})
+            await asyncio.sleep(self.retry)
+        self.held = True
+        waited = time.perf_counter() - started
+        log.info(
+            "lease acquired",
+            extra={"lease": self.name, "holder": self.holder, "wait_ms": round(waited * 1000)},
+        )
+        return waited
+
+    def start_heartbeat(self, on_handover):
+        """on_handover() — корутина: кто-то попросил аренду или она уже потеряна, пора перестать поллить."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._beat(on_handover), name="lease-heartbeat")
+
+    async def _beat(self, on_handover):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                held, handover_to = await self.repo.renew(self.name, self.holder, self.ttl)
+            except Exception as e:
+                # БД недоступна — продолжаем поллить: аренда истечёт сама, если это надолго
+                logs.swallowed("lease.renew", e, log)
+                continue
+            if held and not handover_to:
+                continue
+
+            self.held = held
+            log.info(
+                "handing over polling" if held else "lease lost",
+                extra={"lease": self.name, "handover_to": handover_to},
+            )
+            await on_handover()
+            return
+
+    async def release(self):
+        """Остановить heartbeat и отпустить аренду. Повторный вызов ничего не делает."""
+        if self._task is not None:
+            if self._task is not asyncio.current_task():
+                self._task.cancel()
+            self._task = None
+        if not self.held:
+            return
+        self.held = False
+        await self.repo.release(self.name, self.holder)
+        log.info("lease released", extra={"lease": self.name})
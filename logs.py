@@ -0,0 +1,161 @@
+"""
+Логи бота: JSON-строки в stdout.
+
+- в event loop только кладём запись в очередь (QueueHandler → SimpleQueue, без блокировок),
+  форматирование и запись в stdout — в фоновом потоке QueueListener;
+- correlation_id: у всех записей, сделанных во время обработки апдейта, один и тот же id
+  (with_correlation оборачивает хендлеры, id наследуют и порождённые задачи);
+- сэмплирование: extra={"sample": N} — пишем каждую N-ю запись с тем же event;
+- swallowed(): для мест, где ошибку сознательно глотаем, — пишем в лог и считаем в метриках.
+"""
+import atexit
+import functools
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+import metrics
+
+CORRELATION_ID: ContextVar[str | None] = ContextVar("correlation_id", default=None)
+
+# всё, что есть у любой LogRecord; остальное (extra=...) уходит в JSON как поля
+_RECORD_ATTRS = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+
+log = logging.getLogger("bot.logs")
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """Проставляет correlation_id текущего апдейта. Работает в потоке, который пишет лог."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        cid = CORRELATION_ID.get()
+        if cid is not None and not hasattr(record, "correlation_id"):
+            record.correlation_id = cid
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Для шумных событий: extra={"event": ..., "sample": N} пропускает каждую N-ю запись."""
+
+    def __init__(self):
+        super().__init__()
+        self._counters = defaultdict(itertools.count)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        every = getattr(record, "sample", None)
+        if not every or every <= 1:
+            return True
+        key = getattr(record, "event", None) or record.msg
+        return next(self._counters[key]) % every == 0
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # склеиваем сообщение и traceback сразу (аргументы могут поменяться), JSON — уже в фоновом потоке
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup(level: str = "INFO"):
+    """Настроить корневой логгер процесса. Повторный вызов ничего не делает."""
+    global _listener
+    if _listener is not None:
+        return
+
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter())
+
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(records, out, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    # httpx пишет INFO на каждый запрос к Bot API, apscheduler — на каждый запуск джобы
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Дописать очередь и остановить фоновый поток."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def swallowed(where: str, exc: BaseException, logger: logging.Logger = log):
+    """Ошибку сознательно не пробрасываем — но пишем в лог и считаем."""
+    metrics.SWALLOWED_ERRORS.inc(where=where)
+    logger.warning(
+        "swallowed %s in %s: %s",
+        type(exc).__name__,
+        where,
+        exc,
+        exc_info=(type(exc), exc, exc.__traceback__),
+        extra={"event": "swallowed_error", "where": where},
+    )
+
+
+def with_correlation(callback, sample: int = 100):
+    """Обернуть хендлер PTB: correlation_id = update_id + сэмплированная запись о каждом апдейте."""
+    name = getattr(callback, "__name__", repr(callback))
+    logger = logging.getLogger("bot.updates")
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        update_id = getattr(update, "update_id", None)
+        token = CORRELATION_ID.set(f"upd-{update_id}" if update_id is not None else None)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            logger.info(
+                "update handled",
+                extra={
+                    "event": "update",
+                    "handler": name,
+                    "ms": round((time.perf_counter() - started) * 1000, 1),
+                    "sample": sample,
+                },
+            )
+            CORRELATION_ID.reset(token)
+
+    return wrapper
@@ -0,0 +1,179 @@
+"""
+Сторож event loop.
+
+- heartbeat-задача в самом loop раз в interval засыпает и меряет, насколько позже проснулась —
+  это и есть лаг event loop (скользящее окно для /stats + гистограмма в /metrics);
+- поток-сторож видит, что heartbeat давно не отмечался, и снимает стек потока loop прямо
+  во время зависания: кто именно держит loop (хендлер + стек) попадает в лог;
+- если лаг больше SLO — алерт админу, не чаще одного раза в alert_every секунд.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+
+import logs
+import metrics
+
+ALERT_STACK_LINES = 12
+
+log = logging.getLogger("bot.loop_monitor")
+
+
+def _handler_name(frame, handler_file: str | None) -> str:
+    """Самая внешняя функция из файла бота в стеке — это хендлер/джоба, внутри которой завис loop."""
+    name = None
+    while frame is not None:
+        if handler_file and frame.f_code.co_filename == handler_file:
+            name = frame.f_code.co_name
+        frame = frame.f_back
+    return name or "?"
+
+
+class LoopMonitor:
+    def __init__(
+        self,
+        interval: float = 0.1,
+        slow_threshold: float = 0.25,
+        slo: float = 1.0,
+        alert_every: float = 600,
+        window: int = 3000,
+        handler_file: str | None = None,
+    ):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.slo = slo
+        self.alert_every = alert_every
+        self.handler_file = str(Path(handler_file).resolve()) if handler_file else None
+
+        self._lags = deque(maxlen=window)
+        self.slow = deque(maxlen=20)  # последние зависания: (time, секунды, хендлер, стек)
+
+        self._on_alert = None
+        self._last_alert = 0.0
+        self._suppressed = 0
+
+        self._beat = time.perf_counter()
+        self._captured_beat = None
+        self._stall = None  # (хендлер, стек), снятые сторожем во время текущего зависания
+
+        self._loop_thread_id = None
+        self._task: asyncio.Task | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    # ---------- запуск / остановка ----------
+    def start(self, on_alert=None):
+        """Вызывать из потока event loop. on_alert(text) — корутина отправки алерта."""
+        if self._task is not None:
+            return
+        self._on_alert = on_alert
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-monitor")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._stop.set()
+        await asyncio.to_thread(self._thread.join)
+
+    # ---------- heartbeat (в loop) ----------
+    async def _heartbeat(self):
+        while True:
+            self._beat = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - self._beat - self.interval, 0.0)
+            self._lags.append(lag)
+            metrics.LOOP_LAG.observe(lag)
+
+            if lag >= self.slow_threshold:
+                self._report_stall(lag)
+
+    def _report_stall(self, lag: float):
+        handler, stack = self._stall or ("?", [])
+        self._stall = None
+        self.slow.append((time.time(), lag, handler, stack))
+        metrics.SLOW_CALLBACKS.inc(handler=handler)
+        log.warning(
+            "event loop stalled for %.0f ms in %s",
+            lag * 1000,
+            handler,
+            extra={"lag_ms": round(lag * 1000), "handler": handler},
+        )
+
+        if lag < self.slo or self._on_alert is None:
+            return
+        now = time.monotonic()
+        if now - self._last_alert < self.alert_every:
+            self._suppressed += 1
+            return
+        self._last_alert = now
+
+        text = (
+            f"⚠️ Event loop завис на {lag * 1000:.0f} мс (SLO {self.slo * 1000:.0f} мс)\n"
+            f"Хендлер: {handler}\n"
+        )
+        if self._suppressed:
+            text += f"С прошлого алерта ещё зависаний выше SLO: {self._suppressed}\n"
+            self._suppressed = 0
+        if stack:
+            text += "\n" + "".join(stack[-ALERT_STACK_LINES:])
+        asyncio.create_task(self._send_alert(text))
+
+    async def _send_alert(self, text: str):
+        try:
+            await self._on_alert(text)
+        except Exception as e:
+            logs.swallowed("loop_monitor.alert", e, log)
+
+    # ---------- сторож (отдельный поток) ----------
+    def _watch(self):
+        check_every = min(self.interval, self.slow_threshold) / 2
+        while not self._stop.wait(check_every):
+            beat = self._beat
+            overdue = time.perf_counter() - beat - self.interval
+            if overdue < self.slow_threshold or self._captured_beat == beat:
+                continue
+            # loop стоит — снимаем стек один раз на зависание
+            self._captured_beat = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            handler, stack = _handler_name(frame, self.handler_file), traceback.format_stack(frame)
+            self._stall = (handler, stack)
+            # печатаем сразу: если loop не отвиснет, heartbeat об этом уже не расскажет
+            log.warning(
+                "event loop blocked for >%.0f ms in %s",
+                overdue * 1000,
+                handler,
+                extra={"handler": handler, "stack": "".join(stack)},
+            )
+
+    # ---------- для /stats ----------
+    def summary(self) -> tuple | None:
+        """(count, p50, p95, p99, max) по окну, в секундах."""
+        if not self._lags:
+            return None
+        ordered = sorted(self._lags)
+        n = len(ordered)
+        return (
+            n,
+            ordered[int(0.50 * (n - 1))],
+            ordered[int(0.95 * (n - 1))],
+            ordered[int(0.99 * (n - 1))],
+            ordered[-1],
+        )
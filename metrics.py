@@ -0,0 +1,238 @@
+"""
+Метрики бота в формате Prometheus (text exposition 0.0.4) без внешних зависимостей.
+
+- Counter / Gauge / Histogram с метками, всё живёт в памяти процесса;
+- instrument(callback) — обёртка хендлера: латентность, ошибки, сколько сейчас в работе,
+  и отдельно время в БД и в Telegram API за один апдейт (через contextvar);
+- start_server() — aiohttp-эндпоинт /metrics.
+
+Все изменения метрик идут из event loop, поэтому без блокировок.
+"""
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiohttp import web
+from telegram.ext import ApplicationHandlerStop
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_fmt(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def total(self) -> float:
+        """Сумма по всем меткам (например, сколько апдейтов в работе во всех хендлерах)."""
+        return sum(self._values.values())
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [счётчики по бакетам (не накопительные), сумма, количество]
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _labels(self.labelnames, key, f'le="{_fmt(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ====== МЕТРИКИ БОТА ======
+HANDLER_LATENCY = Histogram("bot_handler_latency_seconds", "Время обработки апдейта хендлером", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения из хендлеров", ("handler", "error"))
+HANDLER_IN_FLIGHT = Gauge("bot_handler_in_flight", "Апдейты, которые сейчас обрабатываются", ("handler",))
+UPDATE_DB_SECONDS = Histogram("bot_update_db_seconds", "Время в БД за один апдейт", ("handler",))
+UPDATE_API_SECONDS = Histogram("bot_update_telegram_api_seconds", "Время в Telegram API за один апдейт", ("handler",))
+DB_CALL_SECONDS = Histogram("bot_db_call_seconds", "Длительность вызовов хранилища", ("call",))
+API_CALL_SECONDS = Histogram("bot_telegram_api_call_seconds", "Длительность вызовов Bot API", ("method",))
+LOOP_LAG = Histogram(
+    "bot_event_loop_lag_seconds",
+    "Насколько позже запланированного просыпается heartbeat event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+SWALLOWED_ERRORS = Counter("bot_swallowed_errors_total", "Ошибки, которые сознательно не пробрасываем", ("where",))
+SLOW_CALLBACKS = Counter("bot_slow_callbacks_total", "Зависания event loop дольше порога", ("handler",))
+LANE_LATENCY = Histogram("bot_lane_latency_seconds", "Апдейт в полосе диспетчера: ожидание + обработка", ("lane",))
+LANE_WAIT = Histogram("bot_lane_wait_seconds", "Ожидание слота полосы диспетчера (и очереди пользователя)", ("lane",))
+LANE_PENDING = Gauge("bot_lane_pending", "Апдейты в полосе: ждут слота или обрабатываются", ("lane",))
+
+# время в БД / в Telegram API для текущего апдейта; словарь общий для всех задач,
+# порождённых хендлером (TaskGroup копирует контекст, но ссылка на словарь та же)
+_update_timings: ContextVar[dict | None] = ContextVar("update_timings", default=None)
+
+
+def _add_time(kind: str, seconds: float):
+    timings = _update_timings.get()
+    if timings is not None:
+        timings[kind] += seconds
+
+
+def observe_db_call(call: str, seconds: float):
+    DB_CALL_SECONDS.observe(seconds, call=call)
+    _add_time("db", seconds)
+
+
+def observe_api_call(method: str, seconds: float):
+    API_CALL_SECONDS.observe(seconds, method=method)
+    _add_time("api", seconds)
+
+
+def instrument(callback, name: str | None = None):
+    """Обернуть хендлер PTB: (update, context) -> coroutine."""
+    name = name or getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        timings = {"db": 0.0, "api": 0.0}
+        token = _update_timings.set(timings)
+        HANDLER_IN_FLIGHT.inc(handler=name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception as e:
+            HANDLER_ERRORS.inc(handler=name, error=type(e).__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+            HANDLER_IN_FLIGHT.dec(handler=name)
+            UPDATE_DB_SECONDS.observe(timings["db"], handler=name)
+            UPDATE_API_SECONDS.observe(timings["api"], handler=name)
+            _update_timings.reset(token)
+
+    return wrapper
+
+
+def instrument_repo(repo, prefix: str):
+    """Подменить корутины-методы репозитория хранилища на версии с замером времени."""
+    for attr in dir(repo):
+        if attr.startswith("_"):
+            continue
+        method = getattr(repo, attr)
+        if not inspect.iscoroutinefunction(method):
+            continue
+        setattr(repo, attr, _timed_call(method, f"{prefix}.{attr}"))
+
+
+def _timed_call(method, call: str):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            observe_db_call(call, time.perf_counter() - started)
+
+    return wrapper
+
+
+# ====== HTTP-ЭНДПОИНТ ======
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,138 @@
+"""
+Профилирование живого процесса без передеплоя (команда /profile).
+
+- sample: отдельный поток раз в SAMPLE_INTERVAL снимает стеки всех потоков через
+  sys._current_frames() и копит их в формате collapsed stacks (flamegraph.pl / speedscope).
+  Накладные расходы маленькие и не зависят от того, что делает код. Сэмплер получает GIL
+  не чаще sys.getswitchinterval(), поэтому лучше всего видит долгие участки, которые держат
+  GIL и event loop, — как раз то, что ищем при подвисаниях;
+- cprofile: cProfile на потоке event loop — точные счётчики вызовов, но заметно тормозит бота.
+
+Дамп asyncio-задач показывает, кто чего ждёт в момент снятия.
+"""
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import tempfile
+import threading
+from collections import Counter
+from pathlib import Path
+
+SAMPLE_INTERVAL = 0.005
+PSTATS_TOP = 60
+TASK_STACK_LIMIT = 20
+
+_lock = asyncio.Lock()
+
+
+def is_running() -> bool:
+    return _lock.locked()
+
+
+# ====== SAMPLING ======
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Поток-сэмплер: считает, сколько раз встретился каждый стек."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.counts.most_common())
+
+
+async def sample(seconds: float) -> bytes:
+    sampler = StackSampler()
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        await asyncio.to_thread(sampler.stop)
+    return sampler.collapsed().encode()
+
+
+# ====== CPROFILE ======
+async def cprofile(seconds: float) -> tuple[bytes, bytes]:
+    """(бинарный .pstats для snakeviz/pstats, текстовый топ по cumulative)."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "profile.pstats"
+        profiler.dump_stats(path)
+        raw = path.read_bytes()
+
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PSTATS_TOP)
+    return raw, out.getvalue().encode()
+
+
+# ====== ЗАДАЧИ ASYNCIO ======
+def dump_tasks() -> str:
+    """Все живые задачи event loop со стеками (где каждая сейчас ждёт)."""
+    current = asyncio.current_task()
+    tasks = sorted(asyncio.all_tasks(), key=lambda t: t.get_name())
+    lines = [f"tasks: {len(tasks)}", ""]
+    for task in tasks:
+        coro = task.get_coro()
+        marker = "  (current)" if task is current else ""
+        lines.append(f"{task.get_name()}: {getattr(coro, '__qualname__', coro)}{marker}")
+        for frame in task.get_stack(limit=TASK_STACK_LIMIT):
+            lines.append(f"    {_frame_name(frame)} line {frame.f_lineno}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+async def run(mode: str, seconds: float) -> list[tuple[str, bytes]]:
+    """Снять профиль. Возвращает файлы [(имя, содержимое)]. Одновременно — только один профиль."""
+    async with _lock:
+        # задачи снимаем в середине окна — в момент, когда нагрузка уже идёт
+        dump_at = asyncio.create_task(_dump_tasks_later(seconds / 2))
+        if mode == "cprofile":
+            raw, text = await cprofile(seconds)
+            files = [("profile.pstats", raw), ("profile.txt", text)]
+        else:
+            files = [("stacks.collapsed.txt", await sample(seconds))]
+        files.append(("asyncio-tasks.txt", (await dump_at).encode()))
+        return files
+
+
+async def _dump_tasks_later(delay: float) -> str:
+    await asyncio.sleep(delay)
+    return dump_tasks()
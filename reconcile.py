@@ -0,0 +1,116 @@
+"""
+Сверка платежей Telegram Stars: getStarTransactions ↔ таблица payments.
+
+Транзакции Telegram отдаёт в хронологическом порядке, страницами по offset. Идём по ним
+потоком: на каждую страницу — один запрос в payments по индексу charge_id, в памяти только
+текущая страница. Позиция (offset + дата последней транзакции) хранится в БД, поэтому
+следующий запуск продолжает с того же места и не перечитывает всю историю.
+
+Что попадает в журнал star_ledger (одна запись на (kind, charge_id), повторы игнорируются):
+- refund — рефанд у Telegram (и из /refund — source=admin);
+- missing_in_db — Telegram деньги получил, а платежа у нас нет (подписку не выдали!);
+- mismatch — платёж есть, но сумма или пользователь не совпадают;
+- missing_in_telegram — платёж у нас есть, а у Telegram такой транзакции нет.
+
+Самые свежие транзакции (моложе grace_seconds) не трогаем: платёж мог ещё не успеть записаться.
+fetch_page(offset, limit) -> список StarTransaction — подменяется в тестах.
+"""
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+
+log = logging.getLogger("bot.reconcile")
+
+PAGE_SIZE = 100  # максимум getStarTransactions
+GRACE_SECONDS = 600
+CLOCK_SKEW_SECONDS = 60
+CURSOR_KEY = "stars_reconcile_cursor"
+REPORT_EXAMPLES = 10
+
+
+def _user_id(partner) -> int | None:
+    if partner is not None and getattr(partner, "type", None) == "user":
+        return partner.user.id
+    return None
+
+
+def _page_entries(transactions: list, payments: dict) -> tuple[list[tuple], list[str]]:
+    """Записи журнала по одной странице и charge_id, которые нашлись у Telegram."""
+    entries = []
+    settled = []
+    for tx in transactions:
+        refund_to = _user_id(tx.receiver)
+        if refund_to is not None:
+            # у рефанда тот же id, что у исходного платежа
+            entries.append(("refund", tx.id, refund_to, tx.amount, None, "telegram"))
+            continue
+
+        payer = _user_id(tx.source)
+        if payer is None:
+            continue  # вывод на Fragment, реклама и т.п. — к подпискам не относится
+
+        payment = payments.get(tx.id)
+        if payment is None:
+            entries.append(("missing_in_db", tx.id, payer, tx.amount, f"telegram date {tx.date.isoformat()}", "telegram"))
+            continue
+
+        settled.append(tx.id)
+        if payment["amount"] != tx.amount or payment["user_id"] != payer:
+            details = (
+                f"db: user {payment['user_id']}, {payment['amount']} {payment['currency']}; "
+                f"telegram: user {payer}, {tx.amount} XTR"
+            )
+            entries.append(("mismatch", tx.id, payer, tx.amount, details, "telegram"))
+    return entries, settled
+
+
+async def reconcile(
+    storage,
+    fetch_page,
+    page_size: int = PAGE_SIZE,
+    grace_seconds: float = GRACE_SECONDS,
+) -> dict:
+    """Один проход сверки. Возвращает отчёт: сколько просмотрено, новые записи журнала по видам, примеры."""
+    started_at = datetime.now(timezone.utc).isoformat()
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace_seconds)
+
+    raw = await storage.runtime.get_value(CURSOR_KEY)
+    cursor = json.loads(raw) if raw else {"offset": 0, "last_date": None}
+    scanned = 0
+
+    while True:
+        page = await fetch_page(cursor["offset"], page_size)
+        ready = []
+        for tx in page:
+            if tx.date > cutoff:
+                break
+            ready.append(tx)
+
+        if ready:
+            charge_ids = [tx.id for tx in ready if _user_id(tx.source) is not None]
+            entries, settled = _page_entries(ready, await storage.payments.by_charge_ids(charge_ids))
+            await storage.payments.mark_settled(settled)
+            await storage.ledger.record(entries)
+
+            scanned += len(ready)
+            cursor = {"offset": cursor["offset"] + len(ready), "last_date": ready[-1].date.isoformat()}
+            await storage.runtime.set_value(CURSOR_KEY, json.dumps(cursor))
+
+        if len(ready) < len(page) or len(page) < page_size:
+            break
+
+    # всё, что оплачено заметно раньше последней сверенной транзакции, у Telegram уже должно быть
+    if cursor["last_date"]:
+        paid_before = datetime.fromisoformat(cursor["last_date"]) - timedelta(seconds=CLOCK_SKEW_SECONDS)
+        await storage.ledger.flag_unsettled(paid_before.isoformat())
+
+    # новые записи журнала за этот проход (повторы уже известных расхождений не считаются)
+    new = await storage.ledger.counts_since(started_at)
+    report = {
+        "scanned": scanned,
+        "offset": cursor["offset"],
+        "new": new,
+        "examples": await storage.ledger.since(started_at, REPORT_EXAMPLES) if new else [],
+    }
+    log.info("stars reconciled", extra={"scanned": scanned, "offset": cursor["offset"], "new": new})
+    return report
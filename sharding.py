@@ -0,0 +1,193 @@
+"""
+Многопроцессный запуск бота.
+
+Один ingress-процесс забирает апдейты через getUpdates и раскладывает их по воркерам:
+апдейт пользователя user_id всегда уходит в воркер user_id % N. Поэтому user_data,
+дневной лимит тренировок и таймеры удаления живут в памяти «своего» воркера.
+Общее состояние — в хранилище (SQLite в режиме WAL или Postgres, см. storage.py),
+кеш активных подписок воркеры синхронизируют по журналу subscription_changes.
+
+Остановка: SIGINT/SIGTERM — ingress перестаёт забирать апдейты, воркеры дорабатывают свои
+и выходят. SIGHUP (его шлёт воркер на /restart) — то же самое, плюс процесс выходит с кодом рестарта.
+getUpdates ingress забирает только под арендой поллинга (handover.py) — при деплое новый
+инстанс поднимает воркеров и забирает аренду, старый после этого останавливается сам.
+
+Локально: BOT_SHARDS=4 python bot.py
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+
+from telegram import Bot, Update
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+import bot
+import logs
+
+POLL_TIMEOUT_SECONDS = 30
+
+log = logging.getLogger("bot.sharding")
+
+
+def shard_for(update: Update, shard_count: int) -> int:
+    """Номер воркера для апдейта. Апдейты без пользователя (например, из каналов) — в шард 0."""
+    user = update.effective_user
+    if user is not None:
+        return user.id % shard_count
+    chat = update.effective_chat
+    if chat is not None:
+        return chat.id % shard_count
+    return 0
+
+
+# ====== ВОРКЕР ======
+def worker_main(shard_id: int, shard_count: int, updates_queue, ready):
+    """Точка входа процесса-воркера."""
+    bot.SHARD_ID = shard_id
+    bot.SHARD_COUNT = shard_count
+    logs.setup(bot.LOG_LEVEL)
+    # Ctrl+C ловит родитель и аккуратно гасит воркеров через None в очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(shard_id, updates_queue, ready))
+
+
+async def _run_worker(shard_id: int, updates_queue, ready):
+    app = bot.build_application(with_updater=False)
+    loop = asyncio.get_running_loop()
+
+    await app.initialize()
+    # post_init/post_shutdown сами вызываются только в run_polling — здесь зовём руками
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    ready.set()
+    log.info("shard started", extra={"shard": shard_id})
+
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates_queue.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        await bot.prepare_shutdown(app)
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+# ====== INGRESS ======
+async def _run_ingress(queues: list, stop_event: asyncio.Event):
+    shard_count = len(queues)
+    tg = Bot(
+        bot.TOKEN,
+        base_url=bot.TELEGRAM_API_BASE_URL,
+        base_file_url=bot.TELEGRAM_API_FILE_URL,
+        get_updates_request=bot.build_updates_request(),
+    )
+
+    async with tg:
+        await tg.delete_webhook()
+        offset = 0
+
+        try:
+            while not stop_event.is_set():
+                try:
+                    updates = await tg.get_updates(
+                        offset=offset,
+                        timeout=POLL_TIMEOUT_SECONDS,
+                        allowed_updates=Update.ALL_TYPES,
+                    )
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except (TimedOut, NetworkError):
+                    await asyncio.sleep(1)
+                    continue
+
+                for update in updates:
+                    queues[shard_for(update, shard_count)].put(update.to_dict())
+                    offset = update.update_id + 1
+        finally:
+            # подтверждаем Telegram всё, что уже разложили по воркерам
+            # (вернувшиеся здесь апдейты не подтверждаются и придут следующему запуску)
+            if offset:
+                await tg.get_updates(offset=offset, timeout=0, limit=1)
+
+
+def run_sharded(shard_count: int) -> bool:
+    """
+    Поднять shard_count воркеров и ingress в текущем процессе. Блокирует до SIGINT/SIGTERM/SIGHUP.
+    Возвращает True, если остановка — это /restart.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(shard_count)]
+    ready = [ctx.Event() for _ in range(shard_count)]
+    workers = [
+        ctx.Process(
+            target=worker_main,
+            args=(shard_id, shard_count, queues[shard_id], ready[shard_id]),
+            name=f"shard-{shard_id}",
+        )
+        for shard_id in range(shard_count)
+    ]
+    for proc in workers:
+        proc.start()
+
+    restart = False
+
+    async def ingress():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+
+        def on_restart():
+            nonlocal restart
+            restart = True
+            stop_event.set()
+
+        loop.add_signal_handler(signal.SIGHUP, on_restart)
+
+        # поллинг — только под арендой: при деплое старый инстанс отдаёт её новому (см. handover.py).
+        # Просим её, когда воркеры уже прогрели кеши, — иначе апдейты будут ждать их старта
+        for event in ready:
+            await loop.run_in_executor(None, event.wait)
+        storage = await bot.open_db()
+        lease = bot.make_polling_lease(storage)
+        await lease.acquire()
+
+        async def on_handover():
+            stop_event.set()
+
+        lease.start_heartbeat(on_handover)
+
+        poller = asyncio.create_task(_run_ingress(queues, stop_event))
+        await stop_event.wait()
+        poller.cancel()
+        try:
+            await poller
+        except asyncio.CancelledError:
+            pass
+        await lease.release()
+        await bot.close_db()
+
+    log.info("ingress started", extra={"shards": shard_count})
+    try:
+        asyncio.run(ingress())
+    finally:
+        for q in queues:
+            q.put(None)
+        started = time.perf_counter()
+        for proc in workers:
+            proc.join(timeout=bot.SHUTDOWN_HARD_DEADLINE_SECONDS)
+            if proc.is_alive():
+                proc.terminate()
+        log.info(
+            "workers stopped",
+            extra={"restart": restart, "stop_ms": round((time.perf_counter() - started) * 1000)},
+        )
+    return restart
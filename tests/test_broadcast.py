@@ -0,0 +1,61 @@
+"""Рассылка: пул воркеров и падение run_broadcast."""
+import asyncio
+import types
+
+import pytest
+
+import bot
+from storage import SQLiteStorage
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return types.SimpleNamespace(message_id=len(self.sent))
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    storage = SQLiteStorage(tmp_path / "test.db")
+    asyncio.run(storage.init_schema())
+    monkeypatch.setattr(bot, "STORAGE", storage)
+    return storage
+
+
+def test_send_pool_counts_crashed_items_as_failed():
+    delivered = []
+
+    async def send_one(item):
+        if item == 3:
+            raise RuntimeError("boom")
+        await asyncio.sleep(0)
+        delivered.append(item)
+        return "delivered"
+
+    counts = asyncio.run(bot.run_send_pool(list(range(10)), send_one, workers=4))
+
+    assert sorted(delivered) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert dict(counts) == {"delivered": 9, "failed": 1}
+
+
+def test_broadcast_crash_marks_failed_and_reports(storage, monkeypatch):
+    async def crash(items, send_one, workers):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(bot, "run_send_pool", crash)
+    fake = FakeBot()
+
+    async def scenario():
+        await storage.users.track_event(10, "u", is_start=True)
+        broadcast_id = await storage.broadcasts.create(1, "all", "hello")
+        await bot.run_broadcast(fake, broadcast_id)
+        return broadcast_id, await storage.broadcasts.get(broadcast_id), await storage.broadcasts.unfinished_ids()
+
+    broadcast_id, broadcast, unfinished = asyncio.run(scenario())
+
+    assert broadcast["status"] == "failed" and unfinished == []
+    assert [chat_id for chat_id, _ in fake.sent] == [1]
+    assert f"#{broadcast_id}" in fake.sent[0][1] and "RuntimeError: boom" in fake.sent[0][1]
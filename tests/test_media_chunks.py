@@ -0,0 +1,117 @@
+"""Отправка видео тренировки группами: chunk_balanced / training_media / deliver_training."""
+import asyncio
+import itertools
+import types
+
+import pytest
+from telegram.error import BadRequest
+
+import bot
+from content_data import VIDEO_IDS
+
+SLOTS = [
+    (place, month, training)
+    for place, months in VIDEO_IDS.items()
+    for month, trainings in months.items()
+    for training in trainings
+]
+
+
+class FakeBot:
+    """Записывает вызовы Bot API по порядку; send_media_group можно уронить на заданной группе."""
+
+    def __init__(self, fail_group: int | None = None):
+        self.calls = []
+        self.fail_group = fail_group
+        self._ids = itertools.count(1)
+        self._groups = 0
+
+    def _message(self):
+        return types.SimpleNamespace(message_id=next(self._ids))
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self._groups += 1
+        if self._groups == self.fail_group:
+            raise BadRequest("Wrong file identifier/http url specified")
+        self.calls.append(("group", [item.media for item in media], [item.caption for item in media]))
+        return [self._message() for _ in media]
+
+    async def send_video(self, chat_id, video, caption=None, **kwargs):
+        self.calls.append(("video", [video], [caption]))
+        return self._message()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(("text", text))
+        return self._message()
+
+
+@pytest.fixture
+def slot(monkeypatch):
+    """Слот gym / 1 / 1 с n видео v0..v{n-1} (через overlay каталога)."""
+    monkeypatch.setattr(bot, "VAULT_CHAT_ID", 0)
+
+    def load(n):
+        bot.CATALOG.load(1, {"gym": {"1": {"1": [f"v{i}" for i in range(n)]}}})
+        return "gym", "1", "1"
+
+    yield load
+    bot.CATALOG.load(0, {})
+
+
+def deliver(fake, place, month, training):
+    context = types.SimpleNamespace(bot=fake)
+    return asyncio.run(bot.deliver_training(context, 5, place, month, training, 0.0))
+
+
+@pytest.mark.parametrize("n", range(1, 32))
+def test_chunk_balanced_sizes(n):
+    chunks = bot.chunk_balanced(list(range(n)))
+    sizes = [len(chunk) for chunk in chunks]
+
+    assert [item for chunk in chunks for item in chunk] == list(range(n))
+    assert len(chunks) == -(-n // 10)
+    assert max(sizes) <= 10 and max(sizes) - min(sizes) <= 1
+    if n > 1:
+        assert min(sizes) >= 2
+
+
+@pytest.mark.parametrize("place,month,training", SLOTS)
+def test_training_media_every_catalog_slot(place, month, training):
+    plan = bot.build_training_plan(place, month, training)
+    chunks = bot.training_media(plan)
+
+    assert [item.media for chunk in chunks for item in chunk] == [v for v in VIDEO_IDS[place][month][training] if v]
+    assert all(2 <= len(chunk) <= 10 for chunk in chunks)
+    captions = [item.caption for chunk in chunks for item in chunk]
+    assert captions[0] == plan["caption"] and captions[0]
+    assert not any(captions[1:])
+
+
+@pytest.mark.parametrize("n", range(1, 32))
+def test_deliver_training_sends_chunks_in_order(slot, n):
+    fake = FakeBot()
+    deleted = deliver(fake, *slot(n))
+
+    media_calls = [call for call in fake.calls if call[0] != "text"]
+    assert [video for _, videos, _ in media_calls for video in videos] == [f"v{i}" for i in range(n)]
+    if n == 1:
+        assert [kind for kind, *_ in media_calls] == ["video"]
+    else:
+        assert all(kind == "group" and 2 <= len(videos) <= 10 for kind, videos, _ in media_calls)
+
+    captions = [caption for _, _, captions in media_calls for caption in captions]
+    assert captions[0] and not any(captions[1:])
+    # видео раньше текста, и каждое сообщение попадает в список на удаление
+    assert fake.calls[-1][0] == "text" and fake.calls[: len(media_calls)] == media_calls
+    assert len(deleted) == n + sum(1 for call in fake.calls if call[0] == "text")
+
+
+def test_deliver_training_falls_back_from_failed_chunk(slot):
+    fake = FakeBot(fail_group=2)
+    deliver(fake, *slot(23))
+
+    groups = [call[1] for call in fake.calls if call[0] == "group"]
+    singles = [call[1][0] for call in fake.calls if call[0] == "video"]
+    # первая группа дошла, остальное — по одному видео, без повторов и пропусков
+    assert groups == [[f"v{i}" for i in range(8)]]
+    assert singles == [f"v{i}" for i in range(8, 23)]
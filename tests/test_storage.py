@@ -0,0 +1,306 @@
+"""Общие тесты репозиториев storage.py: одни и те же сценарии на SQLite и Postgres."""
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+
+from storage import epoch_day, from_epoch_day
+
+TODAY = date(2026, 1, 10)
+DAY = epoch_day(TODAY)
+
+
+def extend_by(days):
+    """compute для save_many: продлить активную подписку или выдать новую с сегодняшнего дня."""
+
+    def compute(existing):
+        rows = []
+        for user_id in USERS:
+            start_day, end_day = existing.get(user_id, (DAY, DAY - 1))
+            if end_day < DAY:
+                start_day, end_day = DAY, DAY - 1
+            rows.append((user_id, start_day, end_day + days))
+        return rows
+
+    return compute
+
+
+USERS = [1, 2, 3]
+
+
+# ====== ПОДПИСКИ ======
+def test_subscription_save_get_cut_delete(run_storage):
+    async def scenario(storage):
+        subs = storage.subscriptions
+        assert await subs.get(1) is None
+        assert await subs.cut(1, TODAY) is False
+
+        await subs.save(1, TODAY, TODAY + timedelta(days=30))
+        assert await subs.get(1) == {"start": TODAY, "end": TODAY + timedelta(days=30)}
+        assert await subs.end_day(1) == DAY + 30
+
+        assert await subs.cut(1, TODAY + timedelta(days=5)) is True
+        assert await subs.end_day(1) == DAY + 5
+        assert await subs.count_active(DAY) == 1
+        assert await subs.count_active(DAY + 6) == 0
+
+        await subs.delete(1)
+        assert await subs.get(1) is None
+        assert await subs.list_all() == []
+
+    run_storage(scenario)
+
+
+def test_subscription_changes_journal(run_storage):
+    async def scenario(storage):
+        subs = storage.subscriptions
+        start = await subs.last_change_id()
+        await subs.save(1, TODAY, TODAY + timedelta(days=3))
+        await subs.save(2, TODAY, TODAY + timedelta(days=7))
+        await subs.delete(1)
+
+        changes = await subs.changes_after(start)
+        assert [(user_id, end_day) for _, user_id, end_day in changes] == [(1, None), (2, DAY + 7), (1, None)]
+        assert await subs.changes_after(changes[-1][0]) == []
+
+        # удаление несуществующей подписки в журнал не попадает
+        await subs.delete(42)
+        assert await subs.last_change_id() == changes[-1][0]
+
+    run_storage(scenario)
+
+
+def test_save_many_extends_and_grants(run_storage):
+    async def scenario(storage):
+        subs = storage.subscriptions
+        await subs.save(1, TODAY - timedelta(days=10), TODAY + timedelta(days=5))  # активна
+        await subs.save(2, TODAY - timedelta(days=40), TODAY - timedelta(days=10))  # истекла
+
+        written = await subs.save_many(USERS, extend_by(30))
+        assert sorted(written) == [(1, DAY - 10, DAY + 35), (2, DAY, DAY + 29), (3, DAY, DAY + 29)]
+        assert await subs.list_all() == [tuple(row) for row in sorted(written)]
+        assert await subs.get(3) == {"start": TODAY, "end": from_epoch_day(DAY + 29)}
+
+        changes = await subs.changes_after(0)
+        assert sorted(user_id for _, user_id, _ in changes[-3:]) == USERS
+
+    run_storage(scenario)
+
+
+def test_save_many_rolls_back_when_compute_fails(run_storage):
+    async def scenario(storage):
+        subs = storage.subscriptions
+        await subs.save(1, TODAY, TODAY + timedelta(days=5))
+
+        def broken(existing):
+            raise ValueError("boom")
+
+        try:
+            await subs.save_many(USERS, broken)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("save_many проглотил исключение compute")
+
+        # транзакция откатилась и не держит блокировку: следующая запись проходит сразу
+        await asyncio.wait_for(subs.save(2, TODAY, TODAY + timedelta(days=1)), timeout=5)
+        assert [user_id for user_id, _, _ in await subs.list_all()] == [1, 2]
+
+    run_storage(scenario)
+
+
+def test_save_many_concurrent_extensions_add_up(run_storage):
+    async def scenario(storage):
+        # новые user_id: раньше Postgres читал их под FOR UPDATE, который на несуществующие строки не действует
+        await asyncio.gather(*(storage.subscriptions.save_many(USERS, extend_by(10)) for _ in range(4)))
+        assert await storage.subscriptions.list_all() == [(user_id, DAY, DAY + 39) for user_id in USERS]
+
+    run_storage(scenario)
+
+
+def test_save_many_chunks_large_batches(run_storage):
+    async def scenario(storage):
+        user_ids = list(range(1, 2501))
+
+        def grant(existing):
+            assert existing == {7: (DAY, DAY)}
+            return [(user_id, DAY, DAY + 1) for user_id in user_ids]
+
+        await storage.subscriptions.save(7, TODAY, TODAY)
+        await storage.subscriptions.save_many(user_ids, grant)
+        assert await storage.subscriptions.count_active(DAY) == len(user_ids)
+
+        removed = await storage.subscriptions.delete_many(user_ids + [10_000])
+        assert sorted(removed) == user_ids
+        assert await storage.subscriptions.count_active(DAY) == 0
+
+    run_storage(scenario)
+
+
+def test_delete_many_journals_only_existing(run_storage):
+    async def scenario(storage):
+        subs = storage.subscriptions
+        await subs.save(1, TODAY, TODAY + timedelta(days=1))
+        start = await subs.last_change_id()
+
+        assert await subs.delete_many([1, 2]) == [1]
+        assert [user_id for _, user_id, _ in await subs.changes_after(start)] == [1]
+
+    run_storage(scenario)
+
+
+def test_reminders_claimed_once(run_storage):
+    async def scenario(storage):
+        subs = storage.subscriptions
+        end = TODAY + timedelta(days=2)
+        await subs.save(1, TODAY, end)
+
+        assert await subs.expiring_unreminded(DAY, DAY + 3) == [(1, end.isoformat())]
+        assert await subs.claim_reminder(1, end.isoformat()) is True
+        assert await subs.claim_reminder(1, end.isoformat()) is False
+        assert await subs.expiring_unreminded(DAY, DAY + 3) == []
+
+        await subs.release_reminder(1, end.isoformat())
+        assert await subs.expiring_unreminded(DAY, DAY + 3) == [(1, end.isoformat())]
+
+    run_storage(scenario)
+
+
+# ====== ПЛАТЕЖИ И СВЕРКА ======
+def test_payments_and_ledger(run_storage):
+    async def scenario(storage):
+        await storage.payments.save(1, "c1", 100, "XTR", "month", 30)
+        await storage.payments.save(1, "c2", 250, "XTR", "quarter", 90)
+        await storage.payments.save(2, "c3", 100, "XTR")
+
+        last = await storage.payments.last_per_user()
+        assert last[1]["charge_id"] == "c2" and last[1]["duration_days"] == 90
+        assert last[2]["plan_key"] is None
+
+        assert await storage.payments.by_charge_ids([]) == {}
+        found = await storage.payments.by_charge_ids(["c1", "nope"])
+        assert list(found) == ["c1"] and found["c1"]["settled_at"] is None
+
+        await storage.payments.mark_settled(["c1", "c2"])
+        future = (datetime.now(timezone.utc) + timedelta(days=1)).isoformat()
+        assert await storage.ledger.flag_unsettled(future) == 1
+        assert await storage.ledger.flag_unsettled(future) == 0
+
+        entry = ("refund", "c2", 1, 250, "refunded", "reconcile")
+        assert await storage.ledger.record([entry, entry]) == 1
+        assert await storage.ledger.record([]) == 0
+
+        since = "2000-01-01"
+        assert await storage.ledger.counts_since(since) == {"missing_in_telegram": 1, "refund": 1}
+        rows = await storage.ledger.since(since, 10)
+        assert [(row["kind"], row["charge_id"]) for row in rows] == [("missing_in_telegram", "c3"), ("refund", "c2")]
+
+    run_storage(scenario)
+
+
+# ====== РАССЫЛКИ ======
+def test_broadcast_checkpoint_finish_and_fail(run_storage):
+    async def scenario(storage):
+        broadcasts = storage.broadcasts
+        first = await broadcasts.create(1, "all", "hi")
+        second = await broadcasts.create(1, "subs", "hi")
+        assert await broadcasts.unfinished_ids() == [first, second]
+
+        await broadcasts.checkpoint(first, 50, {"delivered": 3, "failed": 1})
+        await broadcasts.checkpoint(first, 90, {"delivered": 2, "blocked": 1})
+        state = await broadcasts.get(first)
+        assert (state["last_user_id"], state["delivered"], state["blocked"], state["failed"]) == (90, 5, 1, 1)
+
+        await broadcasts.checkpoint(first, 90, {}, finished=True)
+        await broadcasts.fail(first)  # завершённую не трогаем
+        await broadcasts.fail(second)
+        assert (await broadcasts.get(first))["status"] == "done"
+        assert (await broadcasts.get(second))["status"] == "failed"
+        assert await broadcasts.unfinished_ids() == []
+
+    run_storage(scenario)
+
+
+# ====== СЛУЖЕБНОЕ СОСТОЯНИЕ И АРЕНДА ======
+def test_runtime_values_and_pending_deletes(run_storage):
+    async def scenario(storage):
+        runtime = storage.runtime
+        assert await runtime.get_value("k") is None
+        await runtime.set_value("k", "1")
+        await runtime.set_value("k", "2")
+        assert await runtime.get_value("k") == "2"
+        assert await runtime.pop_value("k") == "2"
+        assert await runtime.pop_value("k") is None
+
+        rows = [(10, [1, 2], 1_700_000_000), (11, [3], 1_700_000_100)]
+        await runtime.save_pending_deletes(rows)
+        assert sorted(await runtime.take_pending_deletes()) == rows
+        assert await runtime.take_pending_deletes() == []
+
+    run_storage(scenario)
+
+
+def test_lease_handover(run_storage):
+    async def scenario(storage):
+        leases = storage.leases
+        assert await leases.try_acquire("polling", "a", 30) is True
+        assert await leases.try_acquire("polling", "b", 30) is False
+        assert await leases.renew("polling", "a", 30) == (True, None)
+
+        await leases.request_handover("polling", "b")
+        assert await leases.renew("polling", "a", 30) == (True, "b")
+
+        await leases.release("polling", "b")  # чужая аренда не отпускается
+        assert await leases.try_acquire("polling", "b", 30) is False
+        await leases.release("polling", "a")
+        assert await leases.try_acquire("polling", "b", 30) is True
+        assert await leases.renew("polling", "a", 30) == (False, None)
+
+        # истёкшую аренду забирает любой
+        assert await leases.try_acquire("other", "a", -1) is True
+        assert await leases.try_acquire("other", "b", 30) is True
+
+    run_storage(scenario)
+
+
+# ====== КАТАЛОГ И ХРАНИЛИЩЕ ТРЕНИРОВОК ======
+def test_catalog_uploads_and_publish(run_storage):
+    async def scenario(storage):
+        catalog = storage.catalog
+        assert await catalog.latest() == (0, {})
+        assert await catalog.publish(lambda overlay, uploads: overlay, 1) is None
+
+        assert await catalog.add_upload("gym", "m1", "t1", "f1", "u1", False, 1) is None
+        assert await catalog.add_upload("gym", "m1", "t2", "f1-again", "u1", False, 1) == ("gym", "m1", "t1")
+        assert await catalog.add_upload("gym", "m1", "t1", "f2", "u2", True, 1) is None
+        assert await catalog.uploads() == [("gym", "m1", "t1", "f1", False), ("gym", "m1", "t1", "f2", True)]
+
+        def compute(overlay, uploads):
+            return {"gym": {"m1": {"t1": [file_id for *_, file_id, _ in uploads]}}}
+
+        version, overlay, uploads = await catalog.publish(compute, 1)
+        assert version == 1 and overlay == {"gym": {"m1": {"t1": ["f1", "f2"]}}} and len(uploads) == 2
+        assert await catalog.latest() == (1, overlay)
+        assert await catalog.latest_version() == 1
+        assert await catalog.uploads() == []
+
+        # опубликованный файл тоже не загрузить второй раз
+        assert await catalog.add_upload("gym", "m2", "t1", "f1", "u1", False, 1) == ("gym", "m1", "t1")
+        assert await catalog.add_upload("gym", "m2", "t1", "f3", "u3", False, 1) is None
+        assert await catalog.discard_uploads() == 1
+        assert await catalog.uploads() == []
+
+    run_storage(scenario)
+
+
+def test_vault_index(run_storage):
+    async def scenario(storage):
+        vault = storage.vault
+        assert await vault.index() == {}
+        await vault.save("gym", "m1", "t1", "fp1", [10, 11])
+        await vault.save("gym", "m1", "t1", "fp2", [12])
+        await vault.save("home", "m1", "t1", "fp3", [13])
+        assert await vault.index() == {("gym", "m1", "t1"): ("fp2", [12]), ("home", "m1", "t1"): ("fp3", [13])}
+
+        await vault.delete("gym", "m1", "t1")
+        assert list(await vault.index()) == [("home", "m1", "t1")]
+
+    run_storage(scenario)
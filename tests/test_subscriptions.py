@@ -0,0 +1,45 @@
+"""Начисление подписки из бота (оплата, /grant) поверх настоящего SQLite-хранилища."""
+import asyncio
+
+import pytest
+
+import bot
+from storage import SQLiteStorage, from_epoch_day
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    storage = SQLiteStorage(tmp_path / "test.db")
+    asyncio.run(storage.init_schema())
+    monkeypatch.setattr(bot, "STORAGE", storage)
+    monkeypatch.setattr(bot, "ACTIVE_SUBS", bot.ActiveSubscribers())
+    return storage
+
+
+def test_extend_new_then_active(storage):
+    today = bot.today_epoch_day()
+
+    async def scenario():
+        first = await bot.create_or_extend_subscription(1, days=30)
+        second = await bot.manual_grant_subscription(1, days=10)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == {"start": from_epoch_day(today), "end": from_epoch_day(today + 30)}
+    assert second == {"start": from_epoch_day(today), "end": from_epoch_day(today + 40)}
+    assert 1 in bot.ACTIVE_SUBS
+
+
+def test_concurrent_extends_add_up(storage):
+    today = bot.today_epoch_day()
+
+    async def scenario():
+        # две оплаты и /grant одного пользователя одновременно: ни одно начисление не теряется
+        await asyncio.gather(
+            bot.create_or_extend_subscription(1, days=30),
+            bot.create_or_extend_subscription(1, days=30),
+            bot.manual_grant_subscription(1, days=7),
+        )
+        return await storage.subscriptions.end_day(1)
+
+    assert asyncio.run(scenario()) == today + 67
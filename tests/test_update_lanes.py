@@ -0,0 +1,54 @@
+"""LaneUpdateProcessor: очередь пользователя и полоса fast для платежей."""
+import asyncio
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, PreCheckoutQuery, SuccessfulPayment, Update, User
+
+from update_lanes import LaneUpdateProcessor
+
+USER = User(id=1, first_name="u", is_bot=False)
+
+
+def payment_update(update_id: int) -> Update:
+    payment = SuccessfulPayment("XTR", 100, "month", f"charge-{update_id}", "")
+    message = Message(
+        update_id,
+        datetime.now(timezone.utc),
+        Chat(USER.id, Chat.PRIVATE),
+        from_user=USER,
+        successful_payment=payment,
+    )
+    return Update(update_id, message=message)
+
+
+def pre_checkout_update(update_id: int) -> Update:
+    return Update(update_id, pre_checkout_query=PreCheckoutQuery(str(update_id), USER, "XTR", 100, "month"))
+
+
+def run_together(updates) -> int:
+    """Прогнать апдейты через процессор одновременно; сколько обработчиков шло параллельно максимум."""
+    running = 0
+    peak = 0
+
+    async def handler():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def main():
+        processor = LaneUpdateProcessor()
+        await asyncio.gather(*(processor.do_process_update(update, handler()) for update in updates))
+        assert processor.pending == 0 and not processor._user_locks
+
+    asyncio.run(main())
+    return peak
+
+
+def test_payments_of_one_user_run_one_at_a_time():
+    assert run_together([payment_update(i) for i in range(1, 4)]) == 1
+
+
+def test_pre_checkout_does_not_wait_for_user_queue():
+    assert run_together([payment_update(1), pre_checkout_update(2), pre_checkout_update(3)]) == 3
@@ -0,0 +1,132 @@
+"""
+Диспетчер апдейтов с полосами (BaseUpdateProcessor для PTB).
+
+- fast: PreCheckoutQuery и сообщения с SUCCESSFUL_PAYMENT. На pre_checkout Telegram ждёт ответ
+  не дольше 10 секунд — эти апдейты не должны стоять в очереди за меню и загрузкой видео,
+  у них свой лимит параллельности, который остальной трафик занять не может. SUCCESSFUL_PAYMENT
+  при этом идёт в общей очереди пользователя: две оплаты одного пользователя не начисляются
+  одновременно. PreCheckoutQuery ничего не пишет — ему очередь не нужна;
+- default: всё остальное. Апдейты одного пользователя обрабатываются строго по очереди
+  (user_data, дневной лимит тренировок), разные пользователи — параллельно;
+- приоритет: пока в fast есть апдейты, новые апдейты default не начинаются (но не дольше
+  PRIORITY_YIELD_SECONDS — поток платежей не должен остановить бота целиком). Loop один на всех,
+  и под нагрузкой упирается в CPU, — без этого отдельный лимит fast почти ничего не даёт.
+
+Общий лимит PTB (max_concurrent_updates) ставим заведомо большим: если бы ожидающие
+апдейты default держали общий слот, fast-апдейт встал бы за ними в ту же очередь.
+"""
+import asyncio
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+FAST = "fast"
+DEFAULT = "default"
+
+# общий семафор PTB: только защита от совсем бесконечного числа задач, реально ограничивают полосы
+OUTER_LIMIT = 100_000
+PRIORITY_YIELD_SECONDS = 1.0
+
+
+def lane_for(update: object) -> str:
+    if not isinstance(update, Update):
+        return DEFAULT
+    if update.pre_checkout_query is not None:
+        return FAST
+    message = update.message
+    if message is not None and message.successful_payment is not None:
+        return FAST
+    return DEFAULT
+
+
+def _user_key(update: object) -> int | None:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class LaneUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, fast_concurrency: int = 8, default_concurrency: int = 32):
+        super().__init__(OUTER_LIMIT)
+        self.limits = {FAST: fast_concurrency, DEFAULT: default_concurrency}
+        self._lanes = {lane: asyncio.Semaphore(limit) for lane, limit in self.limits.items()}
+        self._user_locks: dict[int, list] = {}  # user_id -> [Lock, сколько апдейтов его ждут/держат]
+        self.pending = 0  # апдейты, которые ждут слота или обрабатываются
+        self._fast_pending = 0
+        self._fast_idle = asyncio.Event()
+        self._fast_idle.set()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update, coroutine) -> None:
+        lane = lane_for(update)
+        self.pending += 1
+        metrics.LANE_PENDING.inc(lane=lane)
+        started = time.perf_counter()
+        try:
+            if lane == DEFAULT:
+                await self._process_in_order(update, lane, coroutine, started)
+            else:
+                await self._process_fast(update, lane, coroutine, started)
+        finally:
+            metrics.LANE_LATENCY.observe(time.perf_counter() - started, lane=lane)
+            metrics.LANE_PENDING.dec(lane=lane)
+            self.pending -= 1
+
+    async def _process_fast(self, update, lane: str, coroutine, started: float):
+        self._fast_pending += 1
+        self._fast_idle.clear()
+        try:
+            if update.pre_checkout_query is not None:
+                await self._process(lane, coroutine, started)
+            else:
+                await self._process_in_order(update, lane, coroutine, started)
+        finally:
+            self._fast_pending -= 1
+            if self._fast_pending == 0:
+                self._fast_idle.set()
+
+    async def _yield_to_fast(self):
+        if self._fast_idle.is_set():
+            return
+        try:
+            await asyncio.wait_for(self._fast_idle.wait(), PRIORITY_YIELD_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _process(self, lane: str, coroutine, started: float):
+        if lane == DEFAULT:
+            await self._yield_to_fast()
+        async with self._lanes[lane]:
+            metrics.LANE_WAIT.observe(time.perf_counter() - started, lane=lane)
+            await coroutine
+
+    async def _process_in_order(self, update, lane: str, coroutine, started: float):
+        user_key = _user_key(update)
+        if user_key is None:
+            await self._process(lane, coroutine, started)
+            return
+
+        entry = self._user_locks.get(user_key)
+        if entry is None:
+            entry = self._user_locks[user_key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # сначала очередь пользователя, потом слот полосы: ждущие своей очереди слот не занимают
+            async with entry[0]:
+                await self._process(lane, coroutine, started)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_key]